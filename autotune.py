@@ -0,0 +1,122 @@
+"""Picks the evaluation (batch_size, tgt_len) with the highest throughput under a memory cap.
+
+autotune() runs short probes over the candidate settings: for each tgt_len, batch sizes
+double from 1 until the peak memory of a probe exceeds the cap (or it runs out of memory).
+Peak memory is max allocated on CUDA and the peak RSS of the process on CPU, so the cap
+includes the model and the corpus. The winner is cached in a JSON file under a key made of
+the model config, the hardware and the probed settings; a later run with the same key skips
+the probes.
+"""
+import hashlib
+import json
+import os
+import platform
+
+import torch
+
+from util import peak_memory_gb, reset_peak_memory
+
+
+def hardware_fingerprint(device) -> str:
+    if device.type == 'cuda':
+        props = torch.cuda.get_device_properties(device)
+        return f'{props.name}|{props.total_memory}|cuda{torch.version.cuda}'
+    cpu = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            cpu = next(line.split(':', 1)[1].strip() for line in f if line.startswith('model name'))
+    except (OSError, StopIteration):
+        pass
+    return f'{cpu}|{os.cpu_count()} cpus|{torch.get_num_threads()} threads|{_total_ram()} bytes'
+
+
+def model_fingerprint(model) -> str:
+    inner = model.module if hasattr(model, 'module') else model
+    fields = [type(inner).__name__, torch.__version__]
+    fields += [f'{k}={getattr(inner, k, None)}' for k in
+               ('n_token', 'n_layer', 'n_head', 'd_model', 'd_head', 'mem_len', 'ext_len', 'clamp_len')]
+    params = list(model.parameters())
+    fields += [str(params[0].dtype), str(sum(p.numel() for p in params)), type(model).__name__]
+    return hashlib.sha1('|'.join(fields).encode()).hexdigest()[:16]
+
+
+def _total_ram() -> int:
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def default_memory_limit_gb(device) -> float:
+    """90% of the GPU memory, 80% of RAM on CPU."""
+    if device.type == 'cuda':
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory / 1e9
+    return 0.8 * _total_ram() / 1e9
+
+
+def _is_oom(e: Exception) -> bool:
+    return isinstance(e, MemoryError) or 'out of memory' in str(e)
+
+
+def autotune(probe, tgt_lens, memory_limit_gb: float, device, cache_path='', cache_key='',
+             max_batch_size=256, log=print):
+    """Returns the (batch_size, tgt_len) with the most tokens/s whose probe stayed within
+    memory_limit_gb.
+
+    probe(batch_size, tgt_len) runs a short evaluation and returns (scored tokens, seconds),
+    excluding its own warm-up. If nothing fits, returns batch size 1 with the first tgt_len.
+    """
+    key = f'{cache_key}|limit={memory_limit_gb:.2f}GB|tgt_lens={list(tgt_lens)}|max_bsz={max_batch_size}'
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if key in cache:
+            entry = cache[key]
+            log(f'autotune: cached bsz {entry["batch_size"]} tgt_len {entry["tgt_len"]} '
+                f'({entry["tok_per_s"]:.0f} tok/s)')
+            return entry['batch_size'], entry['tgt_len']
+
+    best = None
+    for tgt_len in tgt_lens:
+        batch_size = 1
+        while batch_size <= max_batch_size:
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+            reset_peak_memory(device)
+            try:
+                n_tokens, seconds = probe(batch_size, tgt_len)
+            except (RuntimeError, MemoryError) as e:
+                if not _is_oom(e):
+                    raise
+                log(f'autotune: bsz {batch_size:4d} tgt_len {tgt_len:5d} | out of memory')
+                break
+            peak = peak_memory_gb(device)
+            if n_tokens == 0:
+                break  # not enough data for a single batch
+            tok_per_s = n_tokens / max(seconds, 1e-9)
+            fits = peak <= memory_limit_gb
+            log(f'autotune: bsz {batch_size:4d} tgt_len {tgt_len:5d} | {tok_per_s:9.0f} tok/s '
+                f'| peak mem {peak:6.2f}GB' + ('' if fits else f' > {memory_limit_gb:.2f}GB'))
+            if not fits:
+                break
+            if best is None or tok_per_s > best[0]:
+                best = (tok_per_s, batch_size, tgt_len)
+            batch_size *= 2
+    if best is None:
+        log('autotune: no setting fits the memory limit, using bsz 1')
+        return 1, tgt_lens[0]
+
+    tok_per_s, batch_size, tgt_len = best
+    log(f'autotune: best bsz {batch_size} tgt_len {tgt_len} ({tok_per_s:.0f} tok/s)')
+    if cache_path:
+        cache[key] = {'batch_size': batch_size, 'tgt_len': tgt_len, 'tok_per_s': tok_per_s}
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(cache_path + '.tmp', cache_path)
+    return batch_size, tgt_len
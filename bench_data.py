@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""Data pipeline benchmark on a synthetic corpus, with a JSON baseline.
+
+Writes a wt103-style corpus (train/valid/test.txt) of --tokens tokens drawn from a Zipf
+distribution over --vocab words, then times, in tokens/s:
+  count         Vocab.count_file over train.txt
+  encode        Vocab.encode_file(ordered=True) over train.txt
+  cache_save    torch.save of the Corpus, as get_lm_corpus does on first use
+  cache_load    get_lm_corpus from the cache
+  ordered_fixlen, ordered_varlen
+                LMOrderedIterator.get_fixlen_iter / get_varlen_iter over the train tokens
+  shuffled      LMShuffledIterator.stream_iterator over the train sentences
+For the iterators it also reports the bytes torch allocates per batch (from the profiler's
+memory events, in a separate untimed pass). Each measurement is the best of --repeat runs.
+
+python bench_data.py --save bench_data.json                 # record a baseline
+python bench_data.py --compare bench_data.json --threshold 10  # exit 1 on >10% slowdowns
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from data_utils import LMOrderedIterator, LMShuffledIterator, get_lm_corpus
+from utils.vocabulary import Vocab
+
+parser = argparse.ArgumentParser(description='data pipeline benchmark')
+parser.add_argument('--tokens', type=int, default=2000000, help='tokens in train.txt')
+parser.add_argument('--vocab', type=int, default=50000, help='distinct words in the corpus')
+parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the word distribution')
+parser.add_argument('--line_len', type=int, default=60, help='mean words per line')
+parser.add_argument('--batch_size', type=int, default=16)
+parser.add_argument('--tgt_len', type=int, default=128)
+parser.add_argument('--ext_len', type=int, default=0)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--workdir', type=str, default='',
+                    help='where to write the corpus (default: a temporary directory)')
+parser.add_argument('--save', type=str, default='', help='write the results to this JSON baseline')
+parser.add_argument('--compare', type=str, default='', help='compare against this JSON baseline')
+parser.add_argument('--threshold', type=float, default=10.,
+                    help='percent throughput loss (or allocation growth) flagged as a regression')
+args = parser.parse_args()
+
+
+def write_corpus(path, ids, rng):
+    """Lines of ~line_len words w{id}."""
+    words = np.array([f'w{i}' for i in range(args.vocab)])
+    lengths = np.maximum(1, rng.poisson(args.line_len, len(ids) // max(1, args.line_len) + 1))
+    ends = np.cumsum(lengths)
+    ends = ends[ends < len(ids)].tolist() + [len(ids)]
+    with open(path, 'w', encoding='utf-8') as f:
+        start = 0
+        for end in ends:
+            f.write(' ' + ' '.join(words[ids[start:end]]) + ' \n')
+            start = end
+
+
+def best_of(fn):
+    """(min seconds over --repeat runs, result of the last run)."""
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def allocated_bytes(fn):
+    """Bytes allocated by torch while running fn (frees not subtracted)."""
+    from torch.profiler import ProfilerActivity, profile
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(0, e.self_cpu_memory_usage) for e in prof.events())
+
+
+def consume(batches):
+    """Number of batches and of target tokens in them."""
+    n_batches = n_tokens = 0
+    for _, target, _ in batches:
+        n_batches += 1
+        n_tokens += target.numel()
+    return n_batches, n_tokens
+
+
+def main():
+    rng = np.random.RandomState(0)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_data.')
+    os.makedirs(workdir, exist_ok=True)
+    # Zipf-distributed word ids; the wt103 vocab is built from train.txt only, so words
+    # that valid/test would see first are replaced by w0
+    n_eval = args.tokens // 20
+    ids = np.minimum(rng.zipf(args.zipf, args.tokens + 2 * n_eval) - 1, args.vocab - 1)
+    train_ids, eval_ids = ids[:args.tokens], ids[args.tokens:]
+    eval_ids[~np.isin(eval_ids, train_ids)] = 0
+    write_corpus(os.path.join(workdir, 'train.txt'), train_ids, rng)
+    write_corpus(os.path.join(workdir, 'valid.txt'), eval_ids[:n_eval], rng)
+    write_corpus(os.path.join(workdir, 'test.txt'), eval_ids[n_eval:], rng)
+    train_path = os.path.join(workdir, 'train.txt')
+    cache_path = os.path.join(workdir, 'cache.pt')
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    print(f'torch {torch.__version__} | {platform.processor() or platform.machine()} | '
+          f'{args.tokens} tokens, {args.vocab} words in {workdir}')
+
+    results = {}
+
+    def report(name, seconds, tokens, **extra):
+        results[name] = dict(seconds=seconds, tok_per_s=tokens / seconds, **extra)
+        line = f'{name:<15} | {seconds * 1000:9.1f} ms | {tokens / seconds:12.0f} tok/s'
+        if 'bytes_per_batch' in extra:
+            line += f' | {extra["n_batches"]:6d} batches | {extra["bytes_per_batch"]:10.0f} bytes/batch'
+        print(line, flush=True)
+
+    def count():
+        vocab = Vocab(special=['<eos>'], lower_case=False)
+        vocab.count_file(train_path)
+        return vocab
+
+    seconds, vocab = best_of(count)
+    report('count', seconds, args.tokens)
+    vocab.build_vocab()
+    seconds, train = best_of(lambda: vocab.encode_file(train_path, ordered=True))
+    report('encode', seconds, len(train))
+
+    corpus = get_lm_corpus(workdir, 'wt103')
+    n_corpus = len(corpus.train) + len(corpus.valid) + len(corpus.test)
+    seconds, _ = best_of(lambda: torch.save(corpus, cache_path))
+    report('cache_save', seconds, n_corpus, bytes=os.path.getsize(cache_path))
+    seconds, _ = best_of(lambda: get_lm_corpus(workdir, 'wt103'))
+    report('cache_load', seconds, n_corpus)
+
+    sents = vocab.encode_file(train_path, ordered=False)
+    iterators = {
+        'ordered_fixlen': lambda: LMOrderedIterator(train, args.batch_size, args.tgt_len,
+                                                    ext_len=args.ext_len).get_fixlen_iter(),
+        'ordered_varlen': lambda: LMOrderedIterator(train, args.batch_size, args.tgt_len,
+                                                    ext_len=args.ext_len).get_varlen_iter(),
+        'shuffled': lambda: LMShuffledIterator(sents, args.batch_size, args.tgt_len,
+                                               ext_len=args.ext_len).stream_iterator(iter(sents)),
+    }
+    for name, make in iterators.items():
+        np.random.seed(0)
+        seconds, (n_batches, n_tokens) = best_of(lambda: consume(make()))
+        np.random.seed(0)
+        n_bytes = allocated_bytes(lambda: consume(make()))
+        report(name, seconds, n_tokens, n_batches=n_batches, bytes_per_batch=n_bytes / max(1, n_batches))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'torch': torch.__version__,
+                       'corpus': {k: getattr(args, k) for k in ('tokens', 'vocab', 'zipf', 'line_len')},
+                       'batch': {k: getattr(args, k) for k in ('batch_size', 'tgt_len', 'ext_len')},
+                       'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = 0
+        print(f'\ncompared with {args.compare} (threshold {args.threshold:.0f}%)')
+        for name, r in results.items():
+            old = baseline.get(name)
+            if old is None:
+                continue
+            # throughput loss and allocation growth, both positive when worse
+            changes = {'tok_per_s': 100 * (1 - r['tok_per_s'] / old['tok_per_s'])}
+            if 'bytes_per_batch' in r and old.get('bytes_per_batch'):
+                changes['bytes_per_batch'] = 100 * (r['bytes_per_batch'] / old['bytes_per_batch'] - 1)
+            flagged = [k for k, pct in changes.items() if pct > args.threshold]
+            regressions += bool(flagged)
+            print(f'{name:<15} | tok/s {-changes["tok_per_s"]:+6.1f}%' +
+                  (f' | bytes/batch {changes["bytes_per_batch"]:+6.1f}%' if 'bytes_per_batch' in changes else '') +
+                  (f' | REGRESSION: {", ".join(flagged)}' if flagged else ''))
+        if regressions:
+            print(f'{regressions} benchmark(s) regressed by more than {args.threshold:.0f}%')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
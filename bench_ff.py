@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""CPU benchmark of PositionwiseFF vs. its fused / chunked variants at wt103_base sizes.
+
+python bench_ff.py --batch_size 16 --repeat 10
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+from mem_transformer import PositionwiseFF
+
+parser = argparse.ArgumentParser(description='PositionwiseFF benchmark')
+# wt103_base from launch.py
+parser.add_argument('--d_model', type=int, default=512)
+parser.add_argument('--d_inner', type=int, default=2048)
+parser.add_argument('--tgt_len', type=int, default=128)
+parser.add_argument('--batch_size', type=int, default=16)
+parser.add_argument('--dropout', type=float, default=0.1)
+parser.add_argument('--chunk_size', type=int, default=32,
+                    help='sequence chunk size for the chunked inference path')
+parser.add_argument('--repeat', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for default')
+args = parser.parse_args()
+
+
+def bench(fn, repeat):
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+def main():
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(1111)
+
+    inp = torch.randn(args.tgt_len, args.batch_size, args.d_model)
+    n_tokens = args.tgt_len * args.batch_size
+    print(f'd_model {args.d_model} d_inner {args.d_inner} tgt_len {args.tgt_len} '
+          f'bsz {args.batch_size} threads {torch.get_num_threads()}')
+    print(f'[len x bsz x d_inner] intermediate: {n_tokens * args.d_inner * 4 / 1e6:.1f}MB, '
+          f'chunked: {args.chunk_size * args.batch_size * args.d_inner * 4 / 1e6:.1f}MB')
+
+    for pre_lnorm in (False, True):
+        ref = PositionwiseFF(args.d_model, args.d_inner, args.dropout, pre_lnorm=pre_lnorm)
+        fused = copy.deepcopy(ref)
+        fused.fused = True
+        chunked = copy.deepcopy(ref)
+        chunked.fused, chunked.chunk_size = True, args.chunk_size
+
+        # equivalence, with dropout masks drawn from the same seed
+        for module in (ref, fused):
+            module.train()
+            module.zero_grad()
+            torch.manual_seed(0)
+            x = inp.clone().requires_grad_()
+            module(x).sum().backward()
+            module.grads = [x.grad] + [p.grad.clone() for p in module.parameters()]
+        train_diff = max((a - b).abs().max().item() for a, b in zip(ref.grads, fused.grads))
+        with torch.no_grad():
+            ref.eval(), fused.eval(), chunked.eval()
+            out = ref(inp)
+            eval_diff = max((out - fused(inp)).abs().max().item(),
+                            (out - chunked(inp)).abs().max().item())
+
+        def train_step(module):
+            module.train()
+            x = inp.clone().requires_grad_()
+            module(x).sum().backward()
+
+        def eval_step(module):
+            module.eval()
+            with torch.no_grad():
+                module(inp)
+
+        print(f'pre_lnorm={pre_lnorm}  max |diff| train grads {train_diff:.2e} eval {eval_diff:.2e}')
+        for name, module in (('reference', ref), ('fused', fused), ('chunked', chunked)):
+            train_ms = bench(lambda: train_step(module), args.repeat)
+            eval_ms = bench(lambda: eval_step(module), args.repeat)
+            print(f'  {name:<10} | fwd+bwd {train_ms:7.2f} ms | eval fwd {eval_ms:7.2f} ms '
+                  f'| eval tok/s {n_tokens / eval_ms * 1000:9.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Forward/backward benchmark of MemTransformerLM on synthetic data, with a JSON baseline.
+
+Starts from a base config and varies one of attn_type, div_val, mem_len, tgt_len,
+pre_lnorm, same_length and batch_size at a time (--grid: every combination of the listed
+values instead). Each config trains for --steps steps on random tokens fed through
+LMOrderedIterator, with mems carried over, after --warmup steps. It reports median forward,
+backward and full step (forward, backward, optimizer) latency and peak memory (process RSS
+on CPU, as in autotune.py).
+
+python bench_model.py --save bench_model.json                # record a baseline
+python bench_model.py --compare bench_model.json --threshold 10  # exit 1 on >10% slowdowns
+python bench_model.py --attn_type 0,2 --tgt_len 64,128 --grid
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import sys
+import time
+
+import torch
+
+from data_utils import LMOrderedIterator
+from mem_transformer import MemTransformerLM
+from util import peak_memory_gb, reset_peak_memory
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+parser = argparse.ArgumentParser(description='MemTransformerLM benchmark')
+parser.add_argument('--n_token', type=int, default=10000)
+parser.add_argument('--n_layer', type=int, default=4)
+parser.add_argument('--n_head', type=int, default=4)
+parser.add_argument('--d_model', type=int, default=256)
+parser.add_argument('--d_head', type=int, default=64)
+parser.add_argument('--d_inner', type=int, default=1024)
+parser.add_argument('--attn_type', type=int_list, default=[0, 1, 2, 3])
+parser.add_argument('--div_val', type=int_list, default=[1, 4])
+parser.add_argument('--mem_len', type=int_list, default=[64, 0, 256])
+parser.add_argument('--tgt_len', type=int_list, default=[64, 128])
+parser.add_argument('--pre_lnorm', type=int_list, default=[0, 1])
+parser.add_argument('--same_length', type=int_list, default=[0, 1])
+parser.add_argument('--batch_size', type=int_list, default=[8, 16])
+parser.add_argument('--grid', action='store_true',
+                    help='benchmark every combination instead of one variation at a time')
+parser.add_argument('--warmup', type=int, default=2)
+parser.add_argument('--steps', type=int, default=5)
+parser.add_argument('--threads', type=int, default=0, help='torch threads (default: torch default)')
+parser.add_argument('--save', type=str, default='', help='write the results to this JSON baseline')
+parser.add_argument('--compare', type=str, default='', help='compare against this JSON baseline')
+parser.add_argument('--threshold', type=float, default=10.,
+                    help='percent slowdown (or memory growth) flagged as a regression')
+args = parser.parse_args()
+
+SWEPT = ('attn_type', 'div_val', 'mem_len', 'tgt_len', 'pre_lnorm', 'same_length', 'batch_size')
+
+
+def configs():
+    """The first value of every list is the base config."""
+    if args.grid:
+        for values in itertools.product(*(getattr(args, k) for k in SWEPT)):
+            yield dict(zip(SWEPT, values))
+        return
+    base = {k: getattr(args, k)[0] for k in SWEPT}
+    yield base
+    for k in SWEPT:
+        for v in getattr(args, k)[1:]:
+            yield dict(base, **{k: v})
+
+
+def config_name(config):
+    return ' '.join(f'{k}={v}' for k, v in config.items())
+
+
+def bench(config):
+    torch.manual_seed(0)
+    model = MemTransformerLM(args.n_token, args.n_layer, args.n_head, args.d_model, args.d_head, args.d_inner,
+                             dropout=0.1, dropatt=0.0, tie_weight=True, d_embed=args.d_model,
+                             div_val=config['div_val'], tie_projs=[False, True, True],
+                             pre_lnorm=bool(config['pre_lnorm']), tgt_len=config['tgt_len'], ext_len=0,
+                             mem_len=config['mem_len'], cutoffs=[args.n_token // 4, args.n_token // 2],
+                             same_length=bool(config['same_length']), attn_type=config['attn_type'])
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    n_steps = args.warmup + args.steps
+    data = torch.randint(0, args.n_token, (n_steps * config['tgt_len'] * config['batch_size'] + 1,))
+    it = LMOrderedIterator(data, config['batch_size'], config['tgt_len'])
+
+    reset_peak_memory(torch.device('cpu'))
+    forward, backward, step = [], [], []
+    mems = tuple()
+    for i, (inp, tgt, _) in enumerate(it):
+        start = time.perf_counter()
+        ret = model(inp, tgt, *mems)
+        loss, mems = ret[0].float().mean(), ret[1:]
+        t_forward = time.perf_counter()
+        loss.backward()
+        t_backward = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad()
+        end = time.perf_counter()
+        if i >= args.warmup:
+            forward.append(1000 * (t_forward - start))
+            backward.append(1000 * (t_backward - t_forward))
+            step.append(1000 * (end - start))
+    tokens = config['tgt_len'] * config['batch_size']
+    return {'config': config, 'forward_ms': statistics.median(forward), 'backward_ms': statistics.median(backward),
+            'step_ms': statistics.median(step), 'tok_per_s': tokens / statistics.median(step) * 1000,
+            'peak_mem_gb': peak_memory_gb(torch.device('cpu')),
+            'params': sum(p.numel() for p in model.parameters())}
+
+
+def main():
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(f'torch {torch.__version__} | {platform.processor() or platform.machine()} | '
+          f'{torch.get_num_threads()} threads')
+    results = []
+    for config in configs():
+        try:
+            r = bench(config)
+        except Exception as e:  # a broken config should not end the sweep
+            print(f'{config_name(config):<80} | failed: {type(e).__name__}: {e}', flush=True)
+            continue
+        results.append(r)
+        print(f'{config_name(config):<80} | fwd {r["forward_ms"]:7.1f} | bwd {r["backward_ms"]:7.1f} '
+              f'| step {r["step_ms"]:7.1f} ms | {r["tok_per_s"]:7.0f} tok/s | peak {r["peak_mem_gb"]:5.2f}GB',
+              flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                       'model': {k: getattr(args, k) for k in ('n_token', 'n_layer', 'n_head', 'd_model',
+                                                               'd_head', 'd_inner')},
+                       'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {config_name(r['config']): r for r in json.load(f)['results']}
+        regressions = 0
+        print(f'\ncompared with {args.compare} (threshold {args.threshold:.0f}%)')
+        for r in results:
+            old = baseline.get(config_name(r['config']))
+            if old is None:
+                continue
+            changes = {k: 100 * (r[k] / old[k] - 1) for k in ('forward_ms', 'backward_ms', 'step_ms', 'peak_mem_gb')}
+            flagged = [k for k, pct in changes.items() if pct > args.threshold]
+            regressions += bool(flagged)
+            print(f'{config_name(r["config"]):<80} | ' +
+                  ' | '.join(f'{k} {pct:+6.1f}%' for k, pct in changes.items()) +
+                  (f' | REGRESSION: {", ".join(flagged)}' if flagged else ''))
+        if regressions:
+            print(f'{regressions} config(s) regressed by more than {args.threshold:.0f}%')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark of restoring a checkpoint on all ranks (gloo processes on localhost).
+
+Compares broadcasting every parameter separately with util.dist_restore_from_checkpoint
+(parameters and buffers broadcast in flat buckets) and with its shared_fs mode (every rank
+reads the file), counts the broadcasts, and checks that all ranks end up with rank 0's
+weights.
+
+python bench_restore.py --nprocs 4
+python bench_restore.py --nprocs 2 --n_token 10000 --n_layer 4
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import util
+from mem_transformer import MemTransformerLM
+
+parser = argparse.ArgumentParser(description='checkpoint restore benchmark')
+parser.add_argument('--nprocs', type=int, default=4)
+parser.add_argument('--n_token', type=int, default=267735, help='wt103 vocabulary size')
+parser.add_argument('--n_layer', type=int, default=16)
+parser.add_argument('--bucket_cap_mb', type=int, default=25)
+parser.add_argument('--port', type=int, default=29541)
+args = parser.parse_args()
+
+
+class Wrapper:
+    """Stands in for DistributedDataParallel, which only needs .module here."""
+
+    def __init__(self, module):
+        self.module = module
+
+
+def make_model(seed):
+    # wt103_base from launch.py, with the adaptive softmax cutoffs from train.py
+    torch.manual_seed(seed)
+    return MemTransformerLM(args.n_token, n_layer=args.n_layer, n_head=8, d_model=512, d_head=48,
+                            d_inner=2048, dropout=0.1, dropatt=0.0, d_embed=512,
+                            tie_projs=[False, True, True, True], tgt_len=128, ext_len=0,
+                            mem_len=128, cutoffs=[c for c in [20000, 40000, 200000] if c < args.n_token])
+
+
+def per_param_restore(ddp_model, checkpoint_fn):
+    """The old restore: rank 0 loads, then one broadcast per parameter."""
+    if util.get_global_rank() == 0:
+        util.restore_from_checkpoint(ddp_model.module, checkpoint_fn)
+    for p in ddp_model.module.parameters():
+        dist.broadcast(p.data, 0)
+
+
+def worker(rank, checkpoint_fn, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(args.port), RANK=str(rank),
+                      WORLD_SIZE=str(args.nprocs))
+    dist.init_process_group('gloo', rank=rank, world_size=args.nprocs)
+    reference = torch.load(checkpoint_fn).state_dict()
+    broadcast, n_calls = dist.broadcast, [0]
+
+    def counted_broadcast(*args_, **kwargs):
+        n_calls[0] += 1
+        return broadcast(*args_, **kwargs)
+
+    dist.broadcast = counted_broadcast
+
+    out = {}
+    for name, restore in (('per-parameter', per_param_restore),
+                          ('bucketed', lambda m, fn: util.dist_restore_from_checkpoint(
+                              m, fn, bucket_cap_mb=args.bucket_cap_mb)),
+                          ('shared_fs', lambda m, fn: util.dist_restore_from_checkpoint(m, fn, shared_fs=True))):
+        model = Wrapper(make_model(seed=100 + rank))  # different weights on every rank
+        dist.barrier()
+        n_calls[0] = 0
+        start = time.perf_counter()
+        restore(model, checkpoint_fn)
+        dist.barrier()
+        elapsed = time.perf_counter() - start
+        state_dict = model.module.state_dict()
+        exact = all(torch.equal(state_dict[k], reference[k]) for k in reference)
+        out[name] = (elapsed, n_calls[0], exact)
+    results[rank] = out
+    dist.destroy_process_group()
+
+
+def main():
+    model = make_model(seed=0)
+    params = list(model.parameters())
+    n_bytes = sum(p.numel() * p.element_size() for p in params)
+    print(f'{len(params)} parameters, {n_bytes / 1e6:.0f}MB, {args.nprocs} gloo processes')
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint_fn = os.path.join(tmp, 'model-best.pt')
+        torch.save(model, checkpoint_fn)
+        del model, params
+        results = mp.Manager().dict()
+        mp.spawn(worker, args=(checkpoint_fn, results), nprocs=args.nprocs)
+    # on localhost a collective costs microseconds, so the time is dominated by loading and
+    # copying; across nodes each broadcast adds a network latency, scaling with log(ranks)
+    for name in results[0]:
+        elapsed = max(results[r][name][0] for r in range(args.nprocs))
+        exact = all(results[r][name][2] for r in range(args.nprocs))
+        print(f'{name:<14} | {elapsed * 1000:8.1f} ms | {results[0][name][1]:4d} broadcasts '
+              f'| all ranks match rank 0: {exact}')
+        assert exact
+
+
+if __name__ == '__main__':
+    main()
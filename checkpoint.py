@@ -0,0 +1,270 @@
+"""Checkpoint writing off the training loop, and a sharded checkpoint format.
+
+AsyncCheckpointWriter.save() snapshots the objects to host memory (the only part the
+training loop waits for) and hands them to a background thread, which writes each one to a
+temporary file and renames it into place, so a crash mid-write never leaves a truncated
+checkpoint behind.
+
+Sharded format, a directory such as model-best.shards/:
+  index.json                    tensor name -> shard file, plus the version of the save
+  skeleton.pt                   the pickled module with placeholder (1-element) tensors
+  shard-00000-of-00004.bin ...  one file per rank: 8-byte little-endian header length,
+                                JSON header {name: dtype/shape/offset/nbytes}, raw bytes
+Every rank writes the tensors assigned to it, so a save takes 1/world_size of the
+single-writer time. Shard files are memory-mapped on load, so only tensors (and pages)
+that are used are read from disk.
+"""
+import copy
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+
+def snapshot_to_host(obj):
+    """Copies obj so that later training steps can't change it: tensors are copied to CPU,
+    containers are rebuilt, modules are deep-copied with their parameters and buffers
+    replaced by CPU copies (without first duplicating them on the GPU), anything else is
+    deep-copied."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_host(v) for v in obj)
+    if isinstance(obj, nn.Module):
+        memo = {}
+        for p in obj.parameters():
+            memo[id(p)] = nn.Parameter(snapshot_to_host(p), requires_grad=p.requires_grad)
+        for b in obj.buffers():
+            memo[id(b)] = snapshot_to_host(b)
+        return copy.deepcopy(obj, memo)
+    return copy.deepcopy(obj)
+
+
+def atomic_save(obj, path):
+    """Writes obj to path.tmp, then renames it over path. *.bin paths are written as shard
+    files (obj is {name: tensor, '__metadata__': dict}), *.json as JSON, anything else with
+    torch.save."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        if path.endswith('.bin'):
+            _write_shard(obj, f)
+        elif path.endswith('.json'):
+            f.write(json.dumps(obj, indent=1).encode())
+        else:
+            torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+_ALIGN = 64
+
+
+def _write_shard(tensors, f):
+    header = {'__metadata__': tensors.get('__metadata__', {})}
+    offset = 0
+    for name, t in tensors.items():
+        if name == '__metadata__':
+            continue
+        nbytes = t.numel() * t.element_size()
+        header[name] = {'dtype': str(t.dtype).replace('torch.', ''), 'shape': list(t.shape),
+                        'offset': offset, 'nbytes': nbytes}
+        offset += nbytes + (-nbytes) % _ALIGN
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * ((-8 - len(header_bytes)) % _ALIGN)
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+    for name, t in tensors.items():
+        if name == '__metadata__' or t.numel() == 0:
+            continue
+        data = t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+        f.write(data + b'\0' * ((-len(data)) % _ALIGN))
+
+
+def _shard_name(rank, world_size):
+    return f'shard-{rank:05d}-of-{world_size:05d}.bin'
+
+
+def _skeleton(module):
+    """Copy of module whose parameters and buffers are 1-element expanded placeholders."""
+    memo = {}
+    for p in module.parameters():
+        placeholder = torch.zeros((), dtype=p.dtype).expand(p.shape)
+        memo[id(p)] = nn.Parameter(placeholder, requires_grad=p.requires_grad)
+    for b in module.buffers():
+        memo[id(b)] = torch.zeros((), dtype=b.dtype).expand(b.shape)
+    return copy.deepcopy(module, memo)
+
+
+def sharded_save_files(module, path, rank, world_size, version=''):
+    """Returns {file: obj} this rank has to write (with atomic_save, or an
+    AsyncCheckpointWriter) to save module into the sharded directory path.
+
+    Tensors are split between ranks by size without communication: every rank holds the
+    same model and computes the same assignment. Rank 0 also writes the index and the
+    skeleton. version (e.g. the train step) is stored in every file, so a load can tell
+    shards of an interrupted save from a previous save with the same name."""
+    from sharded_opt import partition_params
+
+    os.makedirs(path, exist_ok=True)
+    # state_dict names, plus non-persistent buffers; tied weights are stored once
+    all_named = OrderedDict(module.state_dict(keep_vars=True))
+    for name, b in module.named_buffers():
+        all_named.setdefault(name, b)
+    named, aliases, canonical = OrderedDict(), {}, {}
+    for name, t in all_named.items():
+        if id(t) in canonical:
+            aliases[name] = canonical[id(t)]
+        else:
+            canonical[id(t)] = name
+            named[name] = t
+    owner = {}
+    for r, shard in enumerate(partition_params(list(named.values()), world_size)):
+        for t in shard:
+            owner[id(t)] = r
+    files = {}
+    mine = OrderedDict((name, t.detach()) for name, t in named.items() if owner[id(t)] == rank)
+    mine['__metadata__'] = {'version': str(version)}
+    files[os.path.join(path, _shard_name(rank, world_size))] = mine
+    if rank == 0:
+        files[os.path.join(path, 'skeleton.pt')] = _skeleton(module)
+        files[os.path.join(path, 'index.json')] = {
+            'version': str(version),
+            'world_size': world_size,
+            'tensors': {name: _shard_name(owner[id(t)], world_size) for name, t in named.items()},
+            'aliases': aliases,
+        }
+    return files
+
+
+class ShardedCheckpoint:
+    """Read access to a sharded checkpoint directory. Tensors are views of memory-mapped
+    shard files (copy-on-write: changing them never touches the file), opened on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.files = {}
+
+    def keys(self):
+        """Tensor names, including the names of tied weights (which share the stored copy)."""
+        return list(self.index['tensors']) + list(self.index['aliases'])
+
+    def __contains__(self, name):
+        return name in self.index['tensors'] or name in self.index['aliases']
+
+    def _open(self, fn):
+        if fn not in self.files:
+            with open(os.path.join(self.path, fn), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            header_len = struct.unpack('<Q', mm[:8])[0]
+            header = json.loads(mm[8:8 + header_len].decode())
+            version = header['__metadata__'].get('version')
+            if version != self.index['version']:
+                raise RuntimeError(f'{fn} is from save {version!r}, index is from '
+                                   f'{self.index["version"]!r}: incomplete checkpoint')
+            self.files[fn] = (mm, 8 + header_len, header)
+        return self.files[fn]
+
+    def __getitem__(self, name):
+        name = self.index['aliases'].get(name, name)
+        mm, data_start, header = self._open(self.index['tensors'][name])
+        info = header[name]
+        dtype = getattr(torch, info['dtype'])
+        if info['nbytes'] == 0:
+            return torch.empty(info['shape'], dtype=dtype)
+        data = torch.frombuffer(mm, dtype=torch.uint8, count=info['nbytes'],
+                                offset=data_start + info['offset'])
+        return data.view(dtype).view(info['shape'])
+
+    def state_dict(self):
+        """All tensors as an OrderedDict of lazily mapped tensors."""
+        return OrderedDict((name, self[name]) for name in self.keys())
+
+
+def load_sharded_model(path, device='cpu'):
+    """Rebuilds the module saved in the sharded directory path. On CPU the parameters stay
+    memory-mapped, so pages are only read when the weights are used."""
+    module = torch.load(os.path.join(path, 'skeleton.pt'))
+    ckpt = ShardedCheckpoint(path)
+    for name, p in module.named_parameters():
+        p.data = ckpt[name].to(device)
+    for name, b in list(module.named_buffers()):
+        owner = module
+        *parents, attr = name.split('.')
+        for parent in parents:
+            owner = getattr(owner, parent)
+        owner._buffers[attr] = ckpt[name].to(device)
+    return module
+
+
+class AsyncCheckpointWriter:
+    """Writes checkpoints in a background thread.
+
+    At most max_pending snapshots are in host memory (queued or being written); save()
+    waits for a free slot before taking its snapshot, and that wait counts as stall. Writes
+    happen in submission order. An exception in the writer thread is re-raised by the next
+    save() or wait().
+    """
+
+    def __init__(self, max_pending=1, log=print):
+        self.log = log
+        self.slots = threading.Semaphore(max_pending)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, objs: dict, tag=''):
+        """Snapshots {path: obj} and queues the writes. Returns the stall in seconds."""
+        self._raise_error()
+        start = time.perf_counter()
+        self.slots.acquire()  # released by the writer once this snapshot is on disk
+        try:
+            snapshot = [(path, snapshot_to_host(obj)) for path, obj in objs.items()]
+        except BaseException:
+            self.slots.release()
+            raise
+        self.queue.put((tag, snapshot))
+        stall = time.perf_counter() - start
+        self.log(f'checkpoint {tag}: training stalled {stall * 1000:.0f}ms for the snapshot')
+        return stall
+
+    def wait(self):
+        """Blocks until all queued checkpoints are on disk."""
+        self.queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint write failed') from error
+
+    def _run(self):
+        while True:
+            tag, snapshot = self.queue.get()
+            try:
+                start = time.perf_counter()
+                n_bytes = 0
+                for path, obj in snapshot:
+                    atomic_save(obj, path)
+                    n_bytes += os.path.getsize(path)
+                elapsed = time.perf_counter() - start
+                self.log(f'checkpoint {tag}: wrote {n_bytes / 1e6:.1f}MB in {elapsed:.2f}s '
+                         f'({n_bytes / 1e6 / max(elapsed, 1e-9):.0f}MB/s)')
+            except Exception as e:  # surfaced in the training thread
+                self.error = e
+            finally:
+                snapshot = obj = None  # drop the host copy before freeing its slot
+                self.slots.release()
+                self.queue.task_done()
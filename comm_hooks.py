@@ -0,0 +1,225 @@
+"""Gradient communication hooks: two-level (intra-node, then inter-node) all-reduce with
+optional fp16 or PowerSGD compression of the inter-node traffic.
+
+Hierarchical reduction: reduce-scatter inside the node, all-reduce of the 1/local_size
+shard across nodes, all-gather inside the node. Each rank only sends its shard over the
+network, and the inter-node step is where compression is applied:
+
+  fp16      shard is sent as fp16 (pre-divided by the number of nodes to stay in range)
+  powersgd  shard is reshaped into a matrix M and sent as rank-r factors P = M Q and
+            Q = M^T P (one power iteration, Q warm-started across steps), with error
+            feedback: what the approximation missed is added to the next step's shard
+
+The hooks block until their bucket is reduced, so they trade overlap with backward for
+fewer bytes on the wire; they pay off when inter-node bandwidth is the bottleneck.
+
+GradCommState.pop_bytes() returns the payload bytes this rank passed to collectives since
+the last call, split into intra-node and inter-node.
+
+python comm_hooks.py  # 4-process gloo check on localhost, emulating 2 nodes x 2
+"""
+import math
+
+import torch
+import torch.distributed as dist
+
+
+class GradCommState(object):
+    """Process groups, PowerSGD factors / error-feedback buffers and byte counters.
+
+    local_size: ranks per node, consecutive ranks share a node. 1 means flat reduction over
+    all ranks (compression then applies to the whole all-reduce).
+    compression: 'none', 'fp16' or 'powersgd'.
+    """
+
+    def __init__(self, local_size=1, compression='none', powersgd_rank=4, min_compress_numel=4096):
+        assert compression in ('none', 'fp16', 'powersgd')
+        self.world_size = dist.get_world_size()
+        self.rank = dist.get_rank()
+        assert self.world_size % local_size == 0, 'world size must be a multiple of local_size'
+        self.local_size = local_size
+        self.num_nodes = self.world_size // local_size
+        self.compression = compression
+        self.powersgd_rank = powersgd_rank
+        self.min_compress_numel = min_compress_numel
+
+        # every rank has to create every group, in the same order
+        self.intra_group = self.inter_group = None
+        node, local_rank = divmod(self.rank, local_size)
+        if local_size > 1:
+            for n in range(self.num_nodes):
+                group = dist.new_group(list(range(n * local_size, (n + 1) * local_size)))
+                if n == node:
+                    self.intra_group = group
+        if self.num_nodes > 1:
+            if local_size == 1:
+                self.inter_group = dist.group.WORLD
+            else:
+                for l in range(local_size):
+                    group = dist.new_group(list(range(l, self.world_size, local_size)))
+                    if l == local_rank:
+                        self.inter_group = group
+
+        self.errors = {}  # PowerSGD error feedback, per bucket
+        self.qs = {}  # PowerSGD warm-started Q, per bucket
+        self.bytes_intra = 0
+        self.bytes_inter = 0
+
+    def pop_bytes(self):
+        """Returns (intra-node, inter-node) collective payload bytes since the last call."""
+        counts = self.bytes_intra, self.bytes_inter
+        self.bytes_intra = self.bytes_inter = 0
+        return counts
+
+
+def _nbytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def _orthogonalize(matrix, eps=1e-8):
+    """Gram-Schmidt on the columns of matrix, in place."""
+    for i in range(matrix.size(1)):
+        col = matrix[:, i:i + 1]
+        col.div_(col.norm() + eps)
+        if i + 1 < matrix.size(1):
+            rest = matrix[:, i + 1:]
+            rest.sub_(col * (col.t() @ rest))
+
+
+def _inter_allreduce(state, shard, key):
+    """Sums shard (fp32) across nodes, compressed according to state.compression."""
+    group = state.inter_group
+    if state.compression == 'fp16':
+        half = shard.div(state.num_nodes).half()
+        dist.all_reduce(half, group=group)
+        state.bytes_inter += _nbytes(half)
+        shard.copy_(half.float().mul_(state.num_nodes))
+        return
+    if state.compression == 'none' or shard.numel() < state.min_compress_numel:
+        dist.all_reduce(shard, group=group)
+        state.bytes_inter += _nbytes(shard)
+        return
+
+    # PowerSGD: square-ish matrix view of the shard, zero padded
+    n = shard.numel()
+    cols = int(math.ceil(math.sqrt(n)))
+    rows = int(math.ceil(n / cols))
+    rank = min(state.powersgd_rank, rows, cols)
+    matrix = shard.new_zeros(rows * cols)
+    matrix[:n] = shard
+    if key in state.errors:
+        matrix.add_(state.errors[key])
+    matrix = matrix.view(rows, cols)
+    if key not in state.qs:
+        # same seed on every rank so the initial Q agrees
+        gen = torch.Generator().manual_seed(1000 + key)
+        state.qs[key] = torch.randn(cols, rank, generator=gen).to(shard.device)
+    q = state.qs[key]
+
+    p = matrix @ q
+    dist.all_reduce(p, group=group)
+    _orthogonalize(p)
+    q = matrix.t() @ p
+    dist.all_reduce(q, group=group)
+    state.bytes_inter += _nbytes(p) + _nbytes(q)
+    state.qs[key] = q
+
+    approx = p @ q.t()  # approximates the sum over nodes
+    # error feedback: this node's input minus its share of the approximation
+    state.errors[key] = (matrix - approx / state.num_nodes).view(-1)
+    shard.copy_(approx.view(-1)[:n])
+
+
+def _reduce_scatter(shard, chunks, group):
+    try:
+        dist.reduce_scatter(shard, chunks, group=group)
+    except RuntimeError:
+        # backends without reduce_scatter (gloo in older pytorch)
+        flat = torch.cat(chunks)
+        dist.all_reduce(flat, group=group)
+        shard.copy_(flat.chunk(len(chunks))[dist.get_rank(group)])
+
+
+def reduce_gradients(state, flat, key):
+    """Averages the flat gradient tensor `flat` across all ranks in place and returns it.
+    `key` identifies the bucket (for PowerSGD state) and must be the same on every rank."""
+    work = flat.float()
+    n = work.numel()
+    if state.intra_group is None:
+        if state.inter_group is not None:
+            _inter_allreduce(state, work, key)
+    else:
+        L = state.local_size
+        padded = work.new_zeros(n + (-n) % L)
+        padded[:n] = work
+        chunks = list(padded.chunk(L))
+        shard = torch.empty_like(chunks[0])
+        _reduce_scatter(shard, chunks, state.intra_group)
+        state.bytes_intra += _nbytes(padded)
+        if state.inter_group is not None:
+            _inter_allreduce(state, shard, key)
+        dist.all_gather(chunks, shard, group=state.intra_group)
+        state.bytes_intra += _nbytes(shard)
+        work = padded[:n]
+    flat.copy_(work.div_(state.world_size))
+    return flat
+
+
+def ddp_comm_hook(state, bucket):
+    """DistributedDataParallel.register_comm_hook adapter for reduce_gradients."""
+    tensor = bucket.buffer() if hasattr(bucket, 'buffer') else bucket.get_tensor()
+    reduce_gradients(state, tensor, bucket.index())
+    fut = torch.futures.Future()
+    fut.set_result(tensor)
+    return fut
+
+
+def _check_worker(rank, world_size, port, results):
+    import os
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    torch.manual_seed(rank)
+    grads = [torch.randn(100, 80) for _ in range(3)]
+    expected = []
+    for g in grads:
+        total = g.clone()
+        dist.all_reduce(total)
+        expected.append(total / world_size)
+
+    out = {}
+    steps = 40
+    for local_size, compression in ((1, 'none'), (2, 'none'), (2, 'fp16'), (2, 'powersgd')):
+        state = GradCommState(local_size=local_size, compression=compression, min_compress_numel=0)
+        errors = [0.] * steps
+        for key, (g, e) in enumerate(zip(grads, expected)):
+            # the same gradient for several steps: with error feedback, the sum of the
+            # compressed results converges to the sum of the exact averages
+            total = torch.zeros_like(e.view(-1))
+            for step in range(steps):
+                total += reduce_gradients(state, g.view(-1).clone(), key)
+                err = (total - (step + 1) * e.view(-1)).norm() / ((step + 1) * e.norm())
+                errors[step] = max(errors[step], err.item())
+        intra, inter = state.pop_bytes()
+        out[(local_size, compression)] = (errors, intra / (steps * len(grads)), inter / (steps * len(grads)))
+    results[rank] = out
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import torch.multiprocessing as mp
+
+    world_size = 4
+    results = mp.Manager().dict()
+    mp.spawn(_check_worker, args=(world_size, 29522, results), nprocs=world_size)
+    for (local_size, compression), (errors, intra, inter) in results[0].items():
+        mode = f'{"hierarchical" if local_size > 1 else "flat"} {compression}'
+        print(f'{mode:<22} | rel. error of summed grads after 1/10/40 steps '
+              f'{errors[0]:.1e} {errors[9]:.1e} {errors[39]:.1e} '
+              f'| intra-node {intra / 1e3:7.1f}KB/step | inter-node {inter / 1e3:7.1f}KB/step')
+    assert max(results[0][(1, 'none')][0] + results[0][(2, 'none')][0]) < 1e-6
+    assert results[0][(2, 'fp16')][0][-1] < 1e-3
+    powersgd_errors = results[0][(2, 'powersgd')][0]
+    assert powersgd_errors[-1] < powersgd_errors[0] / 4
@@ -9,13 +9,22 @@ source activate pytorch_p36
 python eval.py --data=data/wikitext-103 --dataset=wt103 --batch_size=8 --tgt_len=128 --clamp_len=1000 --mem_len=1600 --work_dir=/ncluster/runs/ben-batch-sched-slow2.01/
 """
 import argparse
+import itertools
 import math
 import os
+import sys
+import time
 
 import torch
+import torch.distributed as dist
 import tqdm
 
-from data_utils import get_lm_corpus
+import autotune
+from data_utils import LMOrderedIterator, get_lm_corpus
+from fp16_opt import BF16_Module
+from nll_dump import NLLDumpWriter
+import util
+from util import load_model
 from utils.exp_utils import get_logger
 
 def main():
@@ -46,61 +55,239 @@ def main():
                         help='set same length attention with masking')
     parser.add_argument('--bpe', action='store_true', default=False,
                         help='Use BPE instead of traditional vocabulary.')
+    parser.add_argument('--precompute_emb', action='store_true',
+                        help='fold adaptive embedding projections into one lookup table')
+    parser.add_argument('--ff_chunk_size', type=int, default=0,
+                        help='run the fused feed-forward in sequence chunks of this size')
+    parser.add_argument('--bf16', action='store_true',
+                        help='evaluate under bfloat16 autocast (works on CPU)')
+    parser.add_argument('--local_procs', type=int, default=0,
+                        help='evaluate with this many processes on this node, each taking a '
+                             'contiguous range of the split (gloo on CPU)')
+    parser.add_argument('--warmup_segments', type=int, default=-2,
+                        help='segments each rank evaluates before its range, unscored, to fill '
+                             'the memory. -2: n_layer * ceil(mem_len / tgt_len), the memory\'s '
+                             'reach through all layers, so the loss is identical to a single '
+                             'process. -1: ceil(mem_len / tgt_len), a full memory only; faster, '
+                             'but the first segments of each range see slightly less context '
+                             'through the deeper layers, so the loss can differ a little')
+    parser.add_argument('--stride', type=int, default=0,
+                        help='fixed-context evaluation: windows of tgt_len tokens every stride '
+                             'tokens, each scoring only its last stride tokens, without memory')
+    parser.add_argument('--autotune', action='store_true',
+                        help='probe batch sizes (and --autotune_tgt_lens) and evaluate with the '
+                             'setting with the most tokens/s under --memory_limit_gb')
+    parser.add_argument('--memory_limit_gb', type=float, default=0,
+                        help='autotune memory cap: peak CUDA allocation or process RSS on CPU '
+                             '(default 90%% of GPU memory / 80%% of RAM)')
+    parser.add_argument('--autotune_tgt_lens', type=str, default='',
+                        help='comma-separated tgt_len candidates (default: only --tgt_len)')
+    parser.add_argument('--autotune_steps', type=int, default=5,
+                        help='timed batches per autotune probe')
+    parser.add_argument('--autotune_cache', type=str,
+                        default=os.path.expanduser('~/.cache/transformer-xl/eval-autotune.json'),
+                        help='results cached per model config and hardware; empty to disable')
+    parser.add_argument('--dump_nll', type=str, default='',
+                        help='write per-token losses to {dump_nll}-{split}.nll (-rank{N} when '
+                             'distributed), see nll_dump.py')
+    parser.add_argument('--local_rank', type=int, default=0,
+                        help='set by --local_procs or the distributed launcher')
 
     args = parser.parse_args()
     assert args.ext_len >= 0, 'extended context length must be non-negative'
+    if args.local_procs > 1 and 'RANK' not in os.environ:
+        sys.exit(util.launch_local_procs(args.local_procs, sys.argv))
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    world_size, rank = util.get_world_size(), util.get_global_rank()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.local_rank)
+        device = torch.device('cuda', args.local_rank)
+    else:
+        device = torch.device('cpu')
+        if args.local_procs:
+            torch.set_num_threads(max(1, os.cpu_count() // args.local_procs))
+    if world_size > 1:
+        dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
 
     # Get logger
     logging = get_logger(os.path.join(args.work_dir, 'eval-log.txt'),
-                         log_=not args.no_log)
+                         print_=rank == 0, log_=not args.no_log and rank == 0)
 
     # Load dataset
     corpus = get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
     ntokens = len(corpus.vocab)
 
     # Load the best saved model.
-    with open(os.path.join(args.work_dir, 'model-best.pt'), 'rb') as f:
-        model = torch.load(f)
+    model = load_model(args.work_dir)
 
     model_tokens = model.n_token if hasattr(model, 'n_token') else model.module.n_token
     assert model_tokens == ntokens, 'vocab size mismatch, did you mean `--bpe`?'
     model = model.to(device)
 
+    if args.stride > 0:
+        assert args.stride <= args.tgt_len, 'stride must not exceed the window (tgt_len)'
+        assert not args.dump_nll, '--dump_nll is only supported for memory-based evaluation'
+        args.ext_len = args.mem_len = 0
+        logging(f'Evaluating windows of {args.tgt_len} tokens with stride {args.stride}, bsz {args.batch_size}')
     logging('Evaluating with bsz {} tgt_len {} ext_len {} mem_len {} clamp_len {}'.format(
         args.batch_size, args.tgt_len, args.ext_len, args.mem_len, args.clamp_len))
 
-    if hasattr(model, 'reset_length'):
-        model.reset_length(args.tgt_len, args.ext_len, args.mem_len)
-    else:
-        model.module.reset_length(args.tgt_len, args.ext_len, args.mem_len)
+    reset_length(model, args.tgt_len, args.ext_len, args.mem_len)
 
     if args.clamp_len > 0:
         model.clamp_len = args.clamp_len
     if args.same_length:
         model.same_length = True
+    if args.precompute_emb:
+        (model.module if hasattr(model, 'module') else model).word_emb.precompute_eval = True
+    if args.ff_chunk_size > 0:
+        (model.module if hasattr(model, 'module') else model).set_fused_ff(True, args.ff_chunk_size)
+    if args.bf16 and not isinstance(model, BF16_Module):
+        model = BF16_Module(model)
+
+    if args.autotune:
+        choice = torch.zeros(2, dtype=torch.long)
+        if rank == 0:
+            choice[:] = torch.tensor(autotune_eval(args, model, corpus, device, logging))
+        if world_size > 1:
+            # one setting for all ranks, or their ranges would not line up
+            choice = choice.to(device)
+            dist.broadcast(choice, 0)
+        args.batch_size, args.tgt_len = choice.tolist()
+        reset_length(model, args.tgt_len, args.ext_len, args.mem_len)
+        logging(f'Evaluating with autotuned bsz {args.batch_size} tgt_len {args.tgt_len}')
+
+    warmup = args.warmup_segments
+    if warmup == -2:
+        n_layer = model.n_layer if hasattr(model, 'n_layer') else model.module.n_layer
+        warmup = n_layer * math.ceil(args.mem_len / args.tgt_len)
+    elif warmup < 0:
+        warmup = math.ceil(args.mem_len / args.tgt_len)
+    if world_size > 1:
+        logging(f'Evaluating on {world_size} ranks with {warmup} warm-up segments each')
 
     # Run on test data.
     for split in ('valid', 'test'):
         if args.split in (split, 'all'):
-            it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
-                device=device, ext_len=args.ext_len)
-            logging(format_log(args, *evaluate(model, it, split), split))
+            start = time.perf_counter()
+            if args.stride > 0:
+                total_loss, total_len = evaluate_strided(
+                    model, getattr(corpus, split).to(device), args.tgt_len, args.stride, args.batch_size,
+                    split, rank=rank, world_size=world_size, progress=rank == 0)
+            else:
+                it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
+                    device=device, ext_len=args.ext_len)
+                n_warmup = 0
+                if world_size > 1:
+                    it, n_warmup = shard_eval_iter(it, rank, world_size, warmup)
+                dump = None
+                if args.dump_nll:
+                    dump = NLLDumpWriter(f'{args.dump_nll}-{split}' + (f'-rank{rank}' if world_size > 1 else '') + '.nll',
+                                         meta={'split': split, 'tgt_len': args.tgt_len, 'mem_len': args.mem_len,
+                                               'ext_len': args.ext_len, 'rank': rank})
+                total_loss, total_len = evaluate(model, it, split, warmup=n_warmup, progress=rank == 0, dump=dump)
+                if dump is not None:
+                    dump.close()
+            if world_size > 1:
+                totals = torch.tensor([total_loss, total_len], dtype=torch.float64, device=device)
+                dist.all_reduce(totals)
+                total_loss, total_len = totals[0].item(), int(totals[1].item())
+            elapsed = time.perf_counter() - start
+            # evaluate() counts positions per batch column, evaluate_strided() every target
+            n_scored = total_len if args.stride > 0 else total_len * args.batch_size
+            logging(format_log(args, total_loss, total_len, split) +
+                    f'| {split} scored {n_scored / elapsed:.0f} tok/s ({elapsed:.1f}s)\n')
+
+
+def reset_length(model, tgt_len, ext_len, mem_len):
+    if hasattr(model, 'reset_length'):
+        model.reset_length(tgt_len, ext_len, mem_len)
+    else:
+        model.module.reset_length(tgt_len, ext_len, mem_len)
+
+
+def autotune_eval(args, model, corpus, device, logging):
+    """Runs autotune.autotune with short evaluations on the start of the valid split and
+    returns the chosen (batch_size, tgt_len)."""
+    tgt_lens = [int(t) for t in args.autotune_tgt_lens.split(',')] if args.autotune_tgt_lens else [args.tgt_len]
+    if args.stride > 0:
+        tgt_lens = [args.tgt_len]  # the window is part of the result, only tune the batch
+    tokens = corpus.valid
+    steps = args.autotune_steps
+
+    def probe(batch_size, tgt_len):
+        if args.stride > 0:
+            n = args.tgt_len + args.stride * batch_size * steps
+            prefix = tokens[:n + 1].to(device)
+            evaluate_strided(model, prefix[:args.tgt_len + args.stride * batch_size + 1], args.tgt_len,
+                             args.stride, batch_size, 'autotune', progress=False)  # warm-up
+            start = time.perf_counter()
+            _, n_tokens = evaluate_strided(model, prefix, args.tgt_len, args.stride, batch_size,
+                                           'autotune', progress=False)
+            return n_tokens, time.perf_counter() - start
+
+        reset_length(model, tgt_len, args.ext_len, args.mem_len)
+        # the first batches fill the memory, time the ones after
+        n_warmup = math.ceil(args.mem_len / tgt_len) + 1
+        n = (n_warmup + steps) * tgt_len * batch_size + 1
+        it = LMOrderedIterator(tokens[:n], batch_size, tgt_len, device=device, ext_len=args.ext_len)
+        n_tokens, start = 0, None
+        model.eval()
+        with torch.no_grad():
+            mems = tuple()
+            for i, (data, target, seq_len) in enumerate(it):
+                if i == n_warmup:
+                    start = time.perf_counter()
+                ret = model(data, target, *mems)
+                loss, mems = ret[0], ret[1:]
+                loss.mean().item()
+                if i >= n_warmup:
+                    n_tokens += seq_len * batch_size
+        return n_tokens, time.perf_counter() - start if start else 0.
 
+    memory_limit_gb = args.memory_limit_gb or autotune.default_memory_limit_gb(device)
+    key = (f'{autotune.model_fingerprint(model)}|{autotune.hardware_fingerprint(device)}'
+           f'|mem_len={args.mem_len}|ext_len={args.ext_len}|stride={args.stride}|bf16={args.bf16}')
+    return autotune.autotune(probe, tgt_lens, memory_limit_gb, device, cache_path=args.autotune_cache,
+                             cache_key=key, log=logging)
 
-def evaluate(model, eval_iter, label: str, max_eval_steps: int = 0):
+
+def shard_eval_iter(eval_iter, rank: int, world_size: int, warmup: int):
+    """Returns (batches, n_warmup): rank's contiguous range of the batches of the ordered
+    iterator eval_iter, preceded by up to `warmup` batches that fill the memory. Evaluating
+    every rank's range and summing gives the single-process result exactly if warmup covers
+    the memory's reach through all layers (n_layer * ceil(mem_len / tgt_len) segments), and
+    closely once it fills the memory (ceil(mem_len / tgt_len))."""
+    assert hasattr(eval_iter, 'get_fixlen_iter'), 'distributed eval needs an ordered dataset'
+    n_batch = len(range(0, eval_iter.data.size(0) - 1, eval_iter.bptt))
+    per_rank = math.ceil(n_batch / world_size)
+    first, last = min(n_batch, rank * per_rank), min(n_batch, (rank + 1) * per_rank)
+    start = max(0, first - warmup)
+    batches = itertools.islice(eval_iter.get_fixlen_iter(start * eval_iter.bptt), last - start)
+    return batches, first - start
+
+
+def evaluate(model, eval_iter, label: str, max_eval_steps: int = 0, warmup: int = 0, progress=True,
+             dump=None):
+    """Returns the sum of seq_len * loss and the number of positions over eval_iter. The
+    first `warmup` batches only fill the memory and are not counted. Per-token losses of
+    the counted batches go to dump (a nll_dump.NLLDumpWriter) if given."""
     # Turn on evaluation mode which disables dropout.
     model.eval()
     total_len, total_loss = 0, 0.
     with torch.no_grad():
         mems = tuple()
-        bar = tqdm.tqdm(eval_iter, leave=False)
+        bar = tqdm.tqdm(eval_iter, leave=False, disable=not progress)
         for i, (data, target, seq_len) in enumerate(bar):
-            if max_eval_steps > 0 and i >= max_eval_steps:
+            if max_eval_steps > 0 and i >= max_eval_steps + warmup:
                 break
+            mem_len = mems[0].size(0) if mems else 0
             ret = model(data, target, *mems)
             loss, mems = ret[0], ret[1:]
+            if i < warmup:
+                continue
+            if dump is not None:
+                dump.add(loss, target, mem_len)
             loss = loss.mean()
             total_loss += seq_len * loss.item()
             total_len += seq_len
@@ -108,6 +295,48 @@ def evaluate(model, eval_iter, label: str, max_eval_steps: int = 0):
     return total_loss, total_len
 
 
+def evaluate_strided(model, tokens, window: int, stride: int, batch_size: int, label: str,
+                     rank: int = 0, world_size: int = 1, progress=True):
+    """Fixed-context evaluation of the 1-D token stream `tokens`, without memory.
+
+    The first window scores its first `window` targets; after that, windows advance by
+    `stride` and score only their last `stride` targets, so every target but the first
+    `window` sees window - 1 tokens of context. Windows of equal shape are stacked along the
+    batch dimension. With world_size > 1 each rank takes a contiguous share of the windows.
+    Returns the summed loss and the number of scored targets."""
+    model.eval()
+    n = tokens.size(0) - 1  # number of targets
+    window = min(window, n)
+    inputs, targets = tokens[:n], tokens[1:n + 1]
+    # window j >= 1 covers [j * stride, j * stride + window) and scores its last stride targets
+    n_full = (n - window) // stride
+    scored_end = window + n_full * stride
+    jobs = []  # (inputs (window, bsz), targets (scored, bsz))
+    if rank == 0:
+        jobs.append((inputs[:window, None], targets[:window, None]))
+    per_rank = math.ceil(n_full / world_size)
+    first, last = 1 + min(n_full, rank * per_rank), 1 + min(n_full, (rank + 1) * per_rank)
+    for j in range(first, last, batch_size):
+        k = min(last, j + batch_size)
+        span = slice(j * stride, (k - 1) * stride + window)
+        inp = inputs[span].unfold(0, window, stride).t()
+        tgt = targets[span].unfold(0, window, stride).t()[-stride:]
+        jobs.append((inp, tgt))
+    if rank == world_size - 1 and scored_end < n:
+        tail = n - scored_end
+        jobs.append((inputs[n - window:, None], targets[n - tail:, None]))
+
+    total_len, total_loss = 0, 0.
+    with torch.no_grad():
+        bar = tqdm.tqdm(jobs, leave=False, disable=not progress)
+        for data, target in bar:
+            loss = model(data.contiguous(), target.contiguous())[0]
+            total_loss += loss.float().sum().item()
+            total_len += target.numel()
+            bar.set_description(f'{label} loss: {total_loss / total_len:.2f}')
+    return total_loss, total_len
+
+
 def format_log(args, loss, total, split):
     if args.dataset in ['enwik8', 'text8']:
         special = f'bpc {loss / math.log(2):9.5f}'
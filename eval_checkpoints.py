@@ -0,0 +1,223 @@
+# coding: utf-8
+"""Evaluates several checkpoints against one load of the corpus.
+
+The corpus is loaded once and the eval batches are built once per device; every checkpoint
+is then evaluated on the same device-resident batch tensors. Each worker (one per GPU, or
+--workers on CPU) takes checkpoints from a shared queue and loads the next one in the
+background while evaluating the current one.
+
+Checkpoints can be model-*.pt files, sharded model-*.shards directories, or work dirs, which
+stand for every model-*.pt / model-*.shards inside them.
+
+python eval_checkpoints.py --data=data/wikitext-103 --dataset=wt103 --tgt_len=128 --mem_len=1600 \
+    --clamp_len=1000 --batch_size=8 /ncluster/runs/run1 /ncluster/runs/run2/model-best.pt
+"""
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import queue
+import re
+import threading
+import time
+
+import torch
+
+from checkpoint import load_sharded_model
+from data_utils import get_lm_corpus
+from eval import evaluate, evaluate_strided, reset_length
+
+
+def expand_checkpoints(paths):
+    """Files and sharded directories as given, work dirs expanded to their model-* checkpoints
+    in natural order (model-2 before model-10)."""
+    def natural_key(name):
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+    result = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'index.json')):
+            names = [n for n in os.listdir(path) if n.startswith('model-') and
+                     (n.endswith('.pt') or os.path.exists(os.path.join(path, n, 'index.json')))]
+            result += [os.path.join(path, n) for n in sorted(names, key=natural_key)]
+        else:
+            result.append(path)
+    return result
+
+
+def load_checkpoint(path, device):
+    if os.path.isdir(path):
+        return load_sharded_model(path).to(device)
+    with open(path, 'rb') as f:
+        return torch.load(f, map_location=device)
+
+
+def prepare_model(model, args):
+    # fp16-trained checkpoints are FP16_Module wrappers; the settings belong on the model
+    base = model.module if hasattr(model, 'module') else model
+    reset_length(base, args.tgt_len, args.ext_len, args.mem_len)
+    if args.clamp_len > 0:
+        base.clamp_len = args.clamp_len
+    if args.same_length:
+        base.same_length = True
+    return model
+
+
+def build_batches(corpus, splits, args, device):
+    """{split: eval batches (or the token stream with --stride)} on device."""
+    batches = {}
+    for split in splits:
+        if args.stride > 0:
+            batches[split] = getattr(corpus, split).to(device)
+        else:
+            batches[split] = list(corpus.get_iterator(split, args.batch_size, args.tgt_len,
+                                                      device=device, ext_len=args.ext_len))
+    return batches
+
+
+def worker(device, batches, todo, results, args, log):
+    loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def next_load():
+        try:
+            path = todo.get_nowait()
+        except queue.Empty:
+            return None
+        return path, loader.submit(load_checkpoint, path, device)
+
+    pending = next_load()
+    while pending is not None:
+        path, future = pending
+        start = time.perf_counter()
+        try:
+            model = future.result()
+        except Exception as e:  # a broken checkpoint must not stop the others
+            model = None
+            for split in batches:
+                results[(path, split)] = f'{type(e).__name__}: {e}'
+            log(f'{path}: failed to load: {type(e).__name__}: {e}')
+        load_time = time.perf_counter() - start
+        pending = next_load()  # overlaps with the evaluation below
+        if model is None:
+            continue
+        prepare_model(model, args)
+        for split, split_batches in batches.items():
+            start = time.perf_counter()
+            try:
+                if args.stride > 0:
+                    loss, n = evaluate_strided(model, split_batches, args.tgt_len, args.stride,
+                                               args.batch_size, split, progress=False)
+                else:
+                    loss, n = evaluate(model, split_batches, split, progress=False)
+            except Exception as e:
+                results[(path, split)] = f'{type(e).__name__}: {e}'
+                log(f'{path} {split}: failed: {type(e).__name__}: {e}')
+                continue
+            results[(path, split)] = (loss, n, time.perf_counter() - start, load_time)
+            log(f'{path} {split}: loss {loss / n:.4f} ({device})')
+        del model
+    loader.shutdown()
+
+
+def format_table(results, checkpoints, splits, bpc):
+    metric = 'bpc' if bpc else 'ppl'
+    width = max([len('checkpoint')] + [len(c) for c in checkpoints])
+    lines = [f'{"checkpoint":<{width}} | {"split":<5} | {"loss":>7} | {metric:>9} | {"eval s":>7} | {"load s":>6}']
+    lines.append('-' * len(lines[0]))
+    for path in checkpoints:
+        for split in splits:
+            result = results[(path, split)]
+            if isinstance(result, str):  # the error message
+                lines.append(f'{path:<{width}} | {split:<5} | failed: {result}')
+                continue
+            loss, n, eval_time, load_time = result
+            value = loss / n / math.log(2) if bpc else math.exp(loss / n)
+            lines.append(f'{path:<{width}} | {split:<5} | {loss / n:7.4f} | {value:9.3f} '
+                         f'| {eval_time:7.1f} | {load_time:6.1f}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluate several checkpoints on one corpus load')
+    parser.add_argument('checkpoints', nargs='+',
+                        help='model-*.pt files, model-*.shards directories or work dirs')
+    parser.add_argument('--data', type=str, default='../data/wikitext-103',
+                        help='location of the data corpus')
+    parser.add_argument('--dataset', type=str, default='wt103',
+                        choices=['wt103', 'lm1b', 'enwik8', 'text8', 'wt2', 'wiki'],
+                        help='dataset name')
+    parser.add_argument('--split', type=str, default='all',
+                        choices=['all', 'valid', 'test'],
+                        help='which split to evaluate')
+    parser.add_argument('--batch_size', type=int, default=10,
+                        help='batch size')
+    parser.add_argument('--tgt_len', type=int, default=5,
+                        help='number of tokens to predict')
+    parser.add_argument('--ext_len', type=int, default=0,
+                        help='length of the extended context')
+    parser.add_argument('--mem_len', type=int, default=0,
+                        help='length of the retained previous heads')
+    parser.add_argument('--clamp_len', type=int, default=-1,
+                        help='max positional embedding index')
+    parser.add_argument('--same_length', action='store_true',
+                        help='set same length attention with masking')
+    parser.add_argument('--stride', type=int, default=0,
+                        help='fixed-context evaluation, see eval.py --stride')
+    parser.add_argument('--bpe', action='store_true', default=False,
+                        help='Use BPE instead of traditional vocabulary.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='checkpoints evaluated concurrently (default: one per GPU, 1 on CPU)')
+    parser.add_argument('--json', type=str, default='',
+                        help='also write the results to this file')
+    args = parser.parse_args()
+    if args.stride > 0:
+        args.ext_len = args.mem_len = 0
+
+    checkpoints = expand_checkpoints(args.checkpoints)
+    assert checkpoints, 'no checkpoints found'
+    splits = [s for s in ('valid', 'test') if args.split in (s, 'all')]
+
+    if torch.cuda.is_available():
+        n_workers = args.workers or torch.cuda.device_count()
+        devices = [torch.device('cuda', i % torch.cuda.device_count()) for i in range(n_workers)]
+    else:
+        n_workers = args.workers or 1
+        devices = [torch.device('cpu')] * n_workers
+        torch.set_num_threads(max(1, torch.get_num_threads() // n_workers))
+
+    start = time.perf_counter()
+    corpus = get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
+    batches = {device: build_batches(corpus, splits, args, device) for device in set(devices)}
+    print(f'corpus and batches ready in {time.perf_counter() - start:.1f}s, '
+          f'{len(checkpoints)} checkpoints on {n_workers} worker(s)')
+
+    todo = queue.Queue()
+    for path in checkpoints:
+        todo.put(path)
+    results = {}
+    lock = threading.Lock()
+
+    def log(msg):
+        with lock:
+            print(msg, flush=True)
+
+    threads = [threading.Thread(target=worker, args=(device, batches[device], todo, results, args, log))
+               for device in devices]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(format_table(results, checkpoints, splits, bpc=args.dataset in ['enwik8', 'text8']))
+    print(f'total {time.perf_counter() - start:.1f}s')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([{'checkpoint': path, 'split': split, 'error': result} if isinstance(result, str) else
+                       {'checkpoint': path, 'split': split, 'loss': result[0] / result[1], 'tokens': result[1],
+                        'eval_seconds': result[2], 'load_seconds': result[3]}
+                       for (path, split), result in results.items()], f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,8 @@ from torch.nn.parameter import Parameter
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from loss_scaler import DynamicLossScaler, LossScaler
-from fp16util import model_grads_to_master_grads, master_params_to_model_params, clip_grad_norm
+from fp16util import model_grads_to_master_grads, master_params_to_model_params
+import fp16util
 
 FLOAT_TYPES = (torch.FloatTensor, torch.cuda.FloatTensor)
 HALF_TYPES = (torch.HalfTensor, torch.cuda.HalfTensor)
@@ -71,6 +72,41 @@ class FP16_Module(nn.Module):
         self.module.load_state_dict(state_dict, strict=strict)
 
 
+def bf16_to_fp32(val):
+    """Convert bf16 `val` to fp32"""
+    def float_conversion(val):
+        if torch.is_tensor(val) and val.dtype == torch.bfloat16:
+            val = val.float()
+        return val
+    return conversion_helper(val, float_conversion)
+
+
+class BF16_Module(nn.Module):
+    """Runs `module` under bfloat16 autocast, on CPU or GPU.
+
+    Unlike :class:`FP16_Module` the parameters stay fp32 and act as the master weights, so
+    any optimizer can be used directly.  bf16 has the fp32 exponent range, so no loss scaling
+    is needed.  Matmuls run in bf16; mem_transformer keeps LayerNorm and softmax in fp32.
+    Outputs are converted back to fp32.
+    """
+    def __init__(self, module):
+        super(BF16_Module, self).__init__()
+        if not hasattr(torch, 'autocast'):
+            raise SystemError("bf16 mode needs torch.autocast (pytorch >= 1.10).")
+        self.add_module('module', module)
+
+    def forward(self, *inputs, **kwargs):
+        device_type = next(self.module.parameters()).device.type
+        with torch.autocast(device_type, dtype=torch.bfloat16):
+            return bf16_to_fp32(self.module(*inputs, **kwargs))
+
+    def state_dict(self, destination=None, prefix='', keep_vars=False):
+        return self.module.state_dict(destination, prefix, keep_vars)
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.module.load_state_dict(state_dict, strict=strict)
+
+
 class FP16_Optimizer(object):
     """
     :class:`FP16_Optimizer` is designed to wrap an existing PyTorch optimizer, 
@@ -104,6 +140,8 @@ class FP16_Optimizer(object):
         dynamic_loss_scale (bool, optional, default=False):  Use dynamic loss scaling.  If True, this will override any ``static_loss_scale`` option.
         dynamic_loss_args (dict, optional, default=None):  Dict of kwargs that will be forwarded to the internal :class:`DynamicLossScaler` instance's constructor.  Keys of this dict must match kwargs accepted by :class:`DynamicLossScaler`'s constructor.  If ``dynamic_loss_args`` is unspecified, :class:`DynamicLossScaler`'s defaults will be used.
         verbose (bool, optional, default=True):  By default, FP16_Optimizer's constructor prints out the parameters and parameter groups it is ingesting, as a sanity check.  If this becomes annoying (e.g. for large models), it can be disabled by passing ``verbose=False``.  ``verbose=False`` will not disable printing when the loss scale is readjusted during dynamic loss scaling.
+        flat_master (bool, optional, default=True):  Store each param group's fp16 model params, fp32 master params and fp32 master grads in three flat contiguous buffers, with the individual tensors as views into them.  Copying grads to the master, downscaling them and copying params back to the model then take one or two bulk ops per group instead of one op per parameter.  The per-parameter tensors (and ``state_dict()``) look the same either way.
+        clip_grad_norm (callable, optional, default=None):  Function ``(params, max_norm, norm_type)`` used by :attr:`clip_master_grads`, e.g. ``util.clip_grad_norm_``, which keeps the norm on the device.  Defaults to ``fp16util.clip_grad_norm``.
 
     ``init_optimizer`` is expected to have been constructed in the ordinary way.  
     It is recommended (although not required) that the newly constructed :class:`FP16_Optimizer` instance be 
@@ -170,7 +208,9 @@ class FP16_Optimizer(object):
                  static_loss_scale=1.0, 
                  dynamic_loss_scale=False,
                  dynamic_loss_args=None,
-                 verbose=False):
+                 verbose=False,
+                 flat_master=True,
+                 clip_grad_norm=None):
         if not torch.cuda.is_available:
             raise SystemError("Cannot use fp16 without CUDA.")
 
@@ -217,6 +257,10 @@ class FP16_Optimizer(object):
             self.fp32_from_fp16_groups.append(fp32_from_fp16_params_this_group)
             self.fp32_from_fp32_groups.append(fp32_params_this_group)
 
+        self.flat_master = flat_master
+        if flat_master:
+            self._flatten_groups()
+
         # Leverage state_dict() and load_state_dict() to recast preexisting per-param state tensors
         self.optimizer.load_state_dict(self.optimizer.state_dict())
         # alternative way to cast per-param state tensors:
@@ -235,7 +279,33 @@ class FP16_Optimizer(object):
         self.overflow = False
         self.first_closure_call_this_step = True
 
-        self.clip_grad_norm = clip_grad_norm
+        self.clip_grad_norm = clip_grad_norm or fp16util.clip_grad_norm
+
+    def _flatten_groups(self):
+        """Moves each group's fp16 params, fp32 master params and master grads into flat
+        buffers. The parameter objects are kept (only their .data is re-pointed to a view),
+        so optimizer state and param_groups keep referring to the same tensors."""
+        self.fp16_flat_groups = []
+        self.fp32_flat_groups = []
+        self.fp32_grad_flat_groups = []
+        for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
+            if not fp16_group:
+                fp16_flat = fp32_flat = grad_flat = None
+            else:
+                fp16_flat = _flatten_dense_tensors([p.data for p in fp16_group])
+                fp32_flat = _flatten_dense_tensors([p.data for p in fp32_from_fp16_group])
+                grad_flat = torch.zeros_like(fp32_flat)
+                views = zip(fp16_group, fp32_from_fp16_group,
+                            _unflatten_dense_tensors(fp16_flat, fp16_group),
+                            _unflatten_dense_tensors(fp32_flat, fp32_from_fp16_group),
+                            _unflatten_dense_tensors(grad_flat, fp32_from_fp16_group))
+                for model_param, master_param, model_view, master_view, grad_view in views:
+                    model_param.data = model_view
+                    master_param.data = master_view
+                    master_param.grad = grad_view
+            self.fp16_flat_groups.append(fp16_flat)
+            self.fp32_flat_groups.append(fp32_flat)
+            self.fp32_grad_flat_groups.append(grad_flat)
 
     def maybe_print(self, msg):
         if self.verbose:
@@ -260,7 +330,9 @@ class FP16_Optimizer(object):
                      p.grad = None
                  else:
                      if p.grad is not None:
-                         p.grad.detach_()
+                         # flat master grads are views, which can't be detached in place
+                         if p.grad.grad_fn is not None:
+                             p.grad.detach_()
                          p.grad.zero_()
 
         # Zero fp16 gradients owned by the model:
@@ -287,23 +359,60 @@ class FP16_Optimizer(object):
         self.loss_scaler.update_scale(has_overflow)
 
     def _master_params_to_model_params(self):
+        if self.flat_master:
+            for fp16_flat, fp32_flat in zip(self.fp16_flat_groups, self.fp32_flat_groups):
+                if fp16_flat is not None:
+                    fp16_flat.copy_(fp32_flat)
+            return
         for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
             master_params_to_model_params(fp16_group, fp32_from_fp16_group)
 
     def _model_params_to_master_params(self):
+        if self.flat_master:
+            for fp16_flat, fp32_flat in zip(self.fp16_flat_groups, self.fp32_flat_groups):
+                if fp32_flat is not None:
+                    fp32_flat.copy_(fp16_flat)
+            return
         for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
             master_params_to_model_params(fp32_from_fp16_group, fp16_group)
 
     # To consider:  Integrate distributed with this wrapper by registering a hook on each variable 
     # that does the overflow check, gradient copy + downscale, and fp32 allreduce in a different stream.
     def _model_grads_to_master_grads(self):
-        for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
-            model_grads_to_master_grads(fp16_group, fp32_from_fp16_group)
+        if not self.flat_master:
+            for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
+                model_grads_to_master_grads(fp16_group, fp32_from_fp16_group)
+            return
+        groups = zip(self.fp16_groups, self.fp32_from_fp16_groups,
+                     self.fp32_grad_flat_groups)
+        for fp16_group, fp32_from_fp16_group, grad_flat in groups:
+            if grad_flat is None:
+                continue
+            # grads may have been set to None (zero_grad(set_grads_to_None=True))
+            for master, grad_view in zip(fp32_from_fp16_group,
+                                         _unflatten_dense_tensors(grad_flat, fp32_from_fp16_group)):
+                if master.grad is None:
+                    master.grad = grad_view
+            model_grads = [p.grad for p in fp16_group]
+            if any(g is None for g in model_grads):
+                # params without a grad must keep master.grad = None so the
+                # optimizer skips them
+                model_grads_to_master_grads(fp16_group, fp32_from_fp16_group)
+            else:
+                grad_flat.copy_(_flatten_dense_tensors([g.data for g in model_grads]))
 
     def _downscale_master(self):
         if self.loss_scale != 1.0:
-            for group in self.optimizer.param_groups:
-                for param in group['params']:
+            if self.flat_master:
+                for grad_flat in self.fp32_grad_flat_groups:
+                    if grad_flat is not None:
+                        grad_flat.mul_(1./self.loss_scale)
+                # fp32 model params are not flattened
+                groups = self.fp32_from_fp32_groups
+            else:
+                groups = [group['params'] for group in self.optimizer.param_groups]
+            for group in groups:
+                for param in group:
                     if param.grad is not None:
                         param.grad.data.mul_(1./self.loss_scale)
 
@@ -1,61 +1,206 @@
 #!/usr/bin/env python
-# /ncluster/runs/one.01/info.log
-# min:  1714.27, median:  1719.90, mean:  1724.42
-# /ncluster/runs/two.01/info.log
-# min:  1770.60, median:  1785.12, mean:  1791.83
-# /ncluster/runs/four.02/info.log
-# min:  1758.16, median:  1769.33, mean:  1786.09
-# /ncluster/runs/eight.02/info.log
-# min:  1951.20, median:  2027.51, mean:  2041.98
-# /ncluster/runs/sixteen.01/info.log
-# min:  1021.19, median:  2081.99, mean:  2083.05
+"""Training throughput of runs, from the logs train.py leaves in their logdirs.
 
+Reads every info-{rank}.log (the '| epoch ... | ms/batch ... | tok/s ...' lines, and the
+'| profile ms p50/p90/p99' lines of --profile runs) and the TensorBoard event files (or
+metrics-0.jsonl) for times/step and times/tokens_per_sec of each run directory. Reports per
+run and per rank: step time distribution, tokens/s (summed over ranks), scaling efficiency
+relative to the run with the fewest ranks, straggler ranks (median step time more than
+--straggler_pct above the run's median) and outlier log intervals (more than --outlier_mads
+median absolute deviations above their rank's median). Everything is local, no cloud access.
 
+python generate_throughput_numbers.py /ncluster/runs/one.01 /ncluster/runs/two.01 --json throughput.json
+
+Numbers from the 300M parameter model on p3dn instances (ms/batch, 8 GPUs per machine):
+  one.01     min 1714.27, median 1719.90, mean 1724.42
+  two.01     min 1770.60, median 1785.12, mean 1791.83
+  four.02    min 1758.16, median 1769.33, mean 1786.09
+  eight.02   min 1951.20, median 2027.51, mean 2041.98
+  sixteen.01 min 1021.19, median 2081.99, mean 2083.05
+"""
+import argparse
+import glob
+import json
 import os
 import re
+import struct
+
 import numpy as np
 
-import subprocess
-
-def ossystem(cmd):
-    """Like os.system, but returns output of command as string."""
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    (stdout, stderr) = p.communicate()
-    return stdout.decode('ascii')
-
-def getlogs(fn):
-    return ossystem(f'ncluster cat {fn}').split('\n')
-
-def get_times(fn):
-    time_list = []
-    for line in getlogs(fn):
-        matches = re.findall('.+ms/batch ([0-9.]+).*', line)
-        if matches:
-            time_list.append(float(matches[0]))
-    time_list = np.array(time_list)
-    min_time = np.min(time_list)
-    median = np.median(time_list)
-    print(fn)
-    print(f"min: {min_time:8.2f}, median: {median:8.2f}, mean: {np.mean(time_list):8.2f}")
-
-
-# This analyzes training throughput of Transformer-XL 300M parameter model
-# training on multiple p3dn instances
-
-
-# 8 GPU throughput
-get_times('/ncluster/runs/one.01/info.log')
-    
-# 16 GPU throughput
-get_times('/ncluster/runs/two.01/info.log')
-    
-# 32 GPU throughput
-get_times('/ncluster/runs/four.02/info.log')
-
-# 64 GPU throughput
-get_times('/ncluster/runs/eight.02/info.log')
-
-# 128 GPU throughput
-get_times('/ncluster/runs/sixteen.01/info.log')
-    
+STEP_RE = re.compile(r'\| epoch +(\d+) step +(\d+) \|.*\| ms/batch +([0-9.]+) \| tok/s +([0-9.]+)')
+PROFILE_RE = re.compile(r'(\w+) ([0-9.]+)/([0-9.]+)/([0-9.]+)')
+ARG_RE = re.compile(r'^    - (\w+) : (.*)$')
+WORLD_RE = re.compile(r'Distributed: success \(\d+/(\d+)\)')
+
+
+def parse_info_log(fn):
+    """Returns (args dict, world size or None, [(step, ms/batch, tok/s)], {phase: [p50]})."""
+    run_args, world_size, steps, profile = {}, None, [], {}
+    with open(fn, errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            m = ARG_RE.match(line)
+            if m:
+                run_args.setdefault(m.group(1), m.group(2))
+                continue
+            m = WORLD_RE.search(line)
+            if m:
+                world_size = int(m.group(1))
+                continue
+            m = STEP_RE.search(line)
+            if m:
+                steps.append((int(m.group(2)), float(m.group(3)), float(m.group(4))))
+                continue
+            if line.startswith('| profile ms'):
+                for name, p50, _, _ in PROFILE_RE.findall(line):
+                    profile.setdefault(name, []).append(float(p50))
+    return run_args, world_size, steps, profile
+
+
+def read_tb_scalars(run_dir, tags=('times/step', 'times/tokens_per_sec')):
+    """{tag: [(token count, value)]} from the run's TensorBoard event files, read directly
+    from the TFRecord framing (needs tensorboardX for the protobuf), or from metrics-0.jsonl
+    for runs logged with --metrics_backend jsonl."""
+    scalars = {}
+    jsonl = os.path.join(run_dir, 'metrics-0.jsonl')
+    if os.path.exists(jsonl):
+        with open(jsonl) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['tag'] in tags and 'value' in record:
+                    scalars.setdefault(record['tag'], []).append((record['step'], record['value']))
+        return scalars
+    try:
+        from tensorboardX.proto.event_pb2 import Event
+    except ImportError:
+        return {}
+    for fn in sorted(glob.glob(os.path.join(run_dir, 'events.out.tfevents.*'))):
+        with open(fn, 'rb') as f:
+            while True:
+                header = f.read(12)
+                if len(header) < 12:
+                    break
+                length = struct.unpack('<Q', header[:8])[0]
+                data = f.read(length)
+                f.read(4)  # data crc
+                if len(data) < length:
+                    break
+                event = Event.FromString(data)
+                for value in event.summary.value:
+                    if value.tag in tags:
+                        scalars.setdefault(value.tag, []).append((event.step, value.simple_value))
+    return scalars
+
+
+def describe(ms):
+    ms = np.asarray(ms)
+    return {'n': int(ms.size), 'min': float(ms.min()), 'p50': float(np.median(ms)),
+            'p90': float(np.percentile(ms, 90)), 'p99': float(np.percentile(ms, 99)),
+            'mean': float(ms.mean())}
+
+
+def analyze_run(run_dir, straggler_pct, outlier_mads, skip_steps):
+    logs = sorted(glob.glob(os.path.join(run_dir, 'info-*.log')),
+                  key=lambda fn: int(re.findall(r'info-(\d+)\.log', fn)[0]))
+    if not logs:
+        return None
+    ranks = {}
+    run_args, world_size = {}, None
+    for fn in logs:
+        rank = int(re.findall(r'info-(\d+)\.log', fn)[0])
+        args_r, world_r, steps, profile = parse_info_log(fn)
+        run_args = run_args or args_r
+        world_size = world_size or world_r
+        # verbose logging steps are single-step intervals right after start-up
+        skip = max(skip_steps, int(args_r.get('verbose_log_steps', 0) or 0))
+        steps = [s for s in steps if s[0] > skip]
+        if steps:
+            ranks[rank] = {'steps': steps, 'profile': profile}
+    if not ranks:
+        return None
+    world_size = world_size or len(logs)
+
+    result = {'run': run_dir, 'world_size': world_size, 'ranks': {}, 'stragglers': [], 'outliers': []}
+    medians = {}
+    for rank, r in sorted(ranks.items()):
+        step_ids, ms, tok = (np.array(x) for x in zip(*r['steps']))
+        stats = describe(ms)
+        stats['tok_per_s'] = float(np.median(tok))
+        if r['profile']:
+            stats['profile_p50'] = {name: float(np.median(v)) for name, v in r['profile'].items()}
+        result['ranks'][rank] = stats
+        medians[rank] = stats['p50']
+        mad = float(np.median(np.abs(ms - stats['p50']))) or 1e-9
+        for step, value in zip(step_ids[ms > stats['p50'] + outlier_mads * mad], ms[ms > stats['p50'] + outlier_mads * mad]):
+            result['outliers'].append({'rank': rank, 'step': int(step), 'ms': float(value),
+                                       'mads': (float(value) - stats['p50']) / mad})
+
+    all_ms = np.concatenate([np.array([s[1] for s in r['steps']]) for r in ranks.values()])
+    result['step_ms'] = describe(all_ms)
+    run_median = float(np.median(list(medians.values())))
+    for rank, median in sorted(medians.items()):
+        if median > run_median * (1 + straggler_pct / 100):
+            result['stragglers'].append({'rank': rank, 'p50_ms': median,
+                                         'slower_pct': 100 * (median / run_median - 1)})
+    # ranks without a log (e.g. logs from other machines not copied) count like the median rank
+    per_rank_tok = [s['tok_per_s'] for s in result['ranks'].values()]
+    result['tok_per_s'] = float(np.median(per_rank_tok) * world_size)
+    result['batch_size'] = run_args.get('batch_size')
+    result['tgt_len'] = run_args.get('tgt_len')
+
+    tb = read_tb_scalars(run_dir)
+    if tb:
+        result['tensorboard'] = {tag: describe([v for _, v in values]) for tag, values in tb.items()}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='training throughput from train.py logdirs')
+    parser.add_argument('runs', nargs='+', help='run directories (logdirs) with info-{rank}.log files')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='run to compute scaling efficiency against (default: fewest ranks)')
+    parser.add_argument('--straggler_pct', type=float, default=5.,
+                        help='flag ranks whose median step time is this much above the run median')
+    parser.add_argument('--outlier_mads', type=float, default=5.,
+                        help='flag log intervals this many median absolute deviations above the median')
+    parser.add_argument('--skip_steps', type=int, default=0,
+                        help='ignore log lines up to this step (start-up)')
+    parser.add_argument('--json', type=str, default='', help='write the full results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for run_dir in args.runs:
+        result = analyze_run(run_dir, args.straggler_pct, args.outlier_mads, args.skip_steps)
+        if result is None:
+            print(f'{run_dir}: no step lines found in info-*.log')
+            continue
+        results.append(result)
+    if not results:
+        return
+
+    baseline = next((r for r in results if os.path.normpath(r['run']) == os.path.normpath(args.baseline)),
+                    None) or min(results, key=lambda r: r['world_size'])
+    base_per_rank = baseline['tok_per_s'] / baseline['world_size']
+    for r in results:
+        r['scaling_efficiency'] = r['tok_per_s'] / r['world_size'] / base_per_rank
+
+    width = max(len('run'), max(len(r['run']) for r in results))
+    print(f'{"run":<{width}} | ranks | ms/batch p50   p90   p99 |     tok/s | efficiency | stragglers | outliers')
+    for r in results:
+        s = r['step_ms']
+        print(f'{r["run"]:<{width}} | {r["world_size"]:5d} | {s["p50"]:9.1f} {s["p90"]:5.1f} {s["p99"]:5.1f} '
+              f'| {r["tok_per_s"]:9.0f} | {r["scaling_efficiency"]:9.1%} '
+              f'| {",".join(str(x["rank"]) for x in r["stragglers"]) or "-":>10} | {len(r["outliers"]):8d}')
+    print(f'efficiency: tok/s per rank relative to {baseline["run"]} ({baseline["world_size"]} ranks)')
+    for r in results:
+        for x in r['stragglers']:
+            print(f'straggler: {r["run"]} rank {x["rank"]} median {x["p50_ms"]:.1f}ms, '
+                  f'{x["slower_pct"]:.1f}% slower than the run median')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
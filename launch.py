@@ -31,6 +31,8 @@ args = parser.parse_args()
 # 'base_lr': gives learning rate relative to  BASE_LR_BATCHSIZE
 # actual learning rate will multiply this by global_batch_size/BASE_LR_BATCHSIZE
 # batch_size: per-GPU batch size
+# grad_accum_steps: micro-batches of batch_size accumulated per optimizer step
+# shard_optimizer: partition optimizer state and master weights across GPUs (ZeRO-1)
 
 # "canonical" batch size os the size base lr is measured to apply linear scaling, do not change
 BASE_LR_BATCHSIZE = 32
@@ -142,6 +144,38 @@ test_16 = {
     'machines': 16,
 }
 
+# Same as test_1, but recomputes decoder layer activations in backward to fit
+# twice the per-GPU batch
+test_1_recompute = {
+    'base_lr': 0.000125 * 5 / 3,
+    'instance_type': 'p3dn.24xlarge',
+    'batch_size': 32,
+    'architecture': 'wt103_large',
+    'machines': 1,
+    'recompute': 'all',
+}
+
+# Reproduces the global batch of test_16 (128 GPUs) on one machine by
+# accumulating gradients over 16 micro-batches
+test_1_accum16 = {
+    'base_lr': 0.001 / 4,
+    'instance_type': 'p3dn.24xlarge',
+    'batch_size': 16,
+    'grad_accum_steps': 16,
+    'architecture': 'wt103_large',
+    'machines': 1,
+}
+
+# test_16 with LAMB state and fp32 master weights sharded over the 128 GPUs
+test_16_sharded = {
+    'base_lr': 0.001 / 4,  # Divide by 4 to counteract batch adjustment
+    'instance_type': 'p3dn.24xlarge',
+    'batch_size': 16,
+    'architecture': 'wt103_large',
+    'machines': 16,
+    'shard_optimizer': True,
+}
+
 ################################################################################
 # Network architectures
 ################################################################################
@@ -209,7 +243,8 @@ def main():
     num_gpus_per_machine = instance_info['gpus']
 
     total_gpus = num_gpus_per_machine * config.machines
-    global_batch_size = config.batch_size * total_gpus
+    grad_accum_steps = config.grad_accum_steps or 1
+    global_batch_size = config.batch_size * total_gpus * grad_accum_steps
 
     # linear LR scaling (https://arxiv.org/abs/1706.02677)
     lr = config.base_lr * (global_batch_size / BASE_LR_BATCHSIZE)
@@ -229,6 +264,7 @@ def main():
         'fp16': True,
         'dynamic_loss_scale': True,
         'batch_size': config.batch_size,
+        'grad_accum_steps': grad_accum_steps,
     }
 
     if config.architecture == 'wt103_large':
@@ -238,6 +274,14 @@ def main():
     else:
         assert False, f"Uknown architecture {config.architecture}"
 
+    # activation recomputation policy, see MemTransformerLM.set_recompute
+    if config.recompute:
+        worker_params['recompute'] = config.recompute
+        if config.recompute_every:
+            worker_params['recompute_every'] = config.recompute_every
+    if config.shard_optimizer:
+        worker_params['shard_optimizer'] = True
+
     nccl_params = f'NCCL_DEBUG=VERSION NCCL_MIN_NRINGS={config.num_rings} '
 
     for i, task in enumerate(job.tasks):
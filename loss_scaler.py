@@ -104,11 +104,34 @@ class DynamicLossScaler:
 
     # `params` is a list / generator of torch.Variable
     def has_overflow(self, params):
-        for p in params:
-            if p.grad is not None and DynamicLossScaler._has_inf_or_nan(p.grad.data):
-                return True
-
-        return False
+        grads = [p.grad.data for p in params if p.grad is not None]
+        return DynamicLossScaler._has_inf_or_nan_multi(grads)
+
+    # `tensors` is a list of torch.Tensor
+    def _has_inf_or_nan_multi(tensors):
+        """Checks all tensors with one host sync and no copies of them. Each tensor is
+        reduced on its device to its inf-norm (max |x|), which is inf or nan exactly when
+        the tensor holds one, and only the largest norm is read back (max propagates nan,
+        and unlike a sum it cannot overflow on large finite values).
+        """
+        buckets = {}
+        for t in tensors:
+            # the inf-norm of an empty tensor is an error, and it cannot overflow anyway
+            if t.numel() > 0:
+                buckets.setdefault((t.device, t.dtype), []).append(t)
+
+        flags = []
+        for (device, _), bucket in buckets.items():
+            if device.type == 'cuda' and hasattr(torch, '_foreach_norm'):
+                norms = torch._foreach_norm(bucket, float('inf'))
+            else:
+                # the same max |x| per tensor; aminmax is much faster than norm on CPU
+                norms = [torch.stack(torch.aminmax(t)).abs().max() for t in bucket]
+            flags.append(torch.stack(norms).max().float().view(1).to(tensors[0].device))
+        if not flags:
+            return False
+        total = float(torch.cat(flags).max())
+        return total != total or total == float('inf')
 
     # `x` is a torch.Tensor
     def _has_inf_or_nan(x):
@@ -7,11 +7,22 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 sys.path.append('utils')
-from proj_adaptive_softmax import ProjectedAdaptiveLogSoftmax
+from proj_adaptive_softmax import ProjectedAdaptiveLogSoftmax, fp32_if_bf16
 from log_uniform_sampler import LogUniformSampler, sample_logits
 
+
+class LayerNorm(nn.LayerNorm):
+    """nn.LayerNorm that computes in fp32 when its input is bf16 (e.g. under BF16_Module
+    autocast) and returns the input dtype."""
+    def forward(self, inp):
+        if inp.dtype != torch.bfloat16:
+            return super(LayerNorm, self).forward(inp)
+        return F.layer_norm(inp.float(), self.normalized_shape, self.weight, self.bias,
+                            self.eps).type_as(inp)
+
 class PositionalEmbedding(nn.Module):
     def __init__(self, demb):
         super(PositionalEmbedding, self).__init__()
@@ -32,7 +43,8 @@ class PositionalEmbedding(nn.Module):
 
 
 class PositionwiseFF(nn.Module):
-    def __init__(self, d_model, d_inner, dropout, pre_lnorm=False):
+    def __init__(self, d_model, d_inner, dropout, pre_lnorm=False, fused=False,
+                 chunk_size=0):
         super(PositionwiseFF, self).__init__()
 
         self.d_model = d_model
@@ -47,11 +59,43 @@ class PositionwiseFF(nn.Module):
         )
 
         # https://nvidia.github.io/apex/layernorm.html
-        self.layer_norm = nn.LayerNorm(d_model)
+        self.layer_norm = LayerNorm(d_model)
 
         self.pre_lnorm = pre_lnorm
 
+        # fused: reuse intermediates in place instead of allocating new ones
+        # chunk_size: without autograd, run the FFN this many positions at a
+        #   time so only a [chunk_size x bsz x d_inner] intermediate is alive
+        self.fused = fused
+        self.chunk_size = chunk_size
+
+    def _core_fused(self, inp):
+        fc1, fc2 = self.CoreNet[0], self.CoreNet[3]
+        core_out = F.relu(F.linear(inp, fc1.weight, fc1.bias), inplace=True)
+        core_out = F.dropout(core_out, self.dropout, self.training)
+        core_out = F.linear(core_out, fc2.weight, fc2.bias)
+        # the second dropout does not need its output for backward, so it
+        # can run in place
+        return F.dropout(core_out, self.dropout, self.training, inplace=True)
+
+    def _forward_fused(self, inp):
+        if self.pre_lnorm:
+            return self._core_fused(self.layer_norm(inp)).add_(inp)
+        return self.layer_norm(self._core_fused(inp).add_(inp))
+
+    def _forward_chunked(self, inp):
+        output = torch.empty_like(inp)
+        for beg in range(0, inp.size(0), self.chunk_size):
+            inp_i = inp[beg:beg + self.chunk_size]
+            output[beg:beg + self.chunk_size] = self._forward_fused(inp_i)
+        return output
+
     def forward(self, inp):
+        if getattr(self, 'fused', False):
+            if getattr(self, 'chunk_size', 0) > 0 and not torch.is_grad_enabled():
+                return self._forward_chunked(inp)
+            return self._forward_fused(inp)
+
         if self.pre_lnorm:
             ##### layer normalization + positionwise feed-forward
             core_out = self.CoreNet(self.layer_norm(inp))
@@ -84,7 +128,7 @@ class MultiHeadAttn(nn.Module):
         self.dropatt = nn.Dropout(dropatt)
         self.o_net = nn.Linear(n_head * d_head, d_model, bias=False)
 
-        self.layer_norm = nn.LayerNorm(d_model)
+        self.layer_norm = LayerNorm(d_model)
 
         self.scale = 1 / (d_head ** 0.5)
 
@@ -120,7 +164,7 @@ class MultiHeadAttn(nn.Module):
                 attn_score.masked_fill_(attn_mask[:,:,:,None], -float('inf'))
 
         # [qlen x klen x bsz x n_head]
-        attn_prob = F.softmax(attn_score, dim=1)
+        attn_prob = F.softmax(fp32_if_bf16(attn_score), dim=1).type_as(attn_score)
         attn_prob = self.dropatt(attn_prob)
 
         # [qlen x klen x bsz x n_head] + [klen x bsz x n_head x d_head] -> [qlen x bsz x n_head x d_head]
@@ -157,7 +201,7 @@ class RelMultiHeadAttn(nn.Module):
         self.dropatt = nn.Dropout(dropatt)
         self.o_net = nn.Linear(n_head * d_head, d_model, bias=False)
 
-        self.layer_norm = nn.LayerNorm(d_model)
+        self.layer_norm = LayerNorm(d_model)
 
         self.scale = 1 / (d_head ** 0.5)
 
@@ -260,7 +304,9 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
         attn_score.mul_(self.scale)
 
         #### compute attention probability
-        if attn_mask is not None and attn_mask.any().item():
+        # masked_fill with an all-False mask is a no-op, so skip the
+        # attn_mask.any() check: it would cost a host sync per layer
+        if attn_mask is not None:
             if attn_mask.dim() == 2:
                 attn_score = attn_score.float().masked_fill(
                     attn_mask[None,:,:,None], -float('inf')).type_as(attn_score)
@@ -269,7 +315,7 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
                     attn_mask[:,:,:,None], -float('inf')).type_as(attn_score)
 
         # [qlen x klen x bsz x n_head]
-        attn_prob = F.softmax(attn_score, dim=1)
+        attn_prob = F.softmax(fp32_if_bf16(attn_score), dim=1).type_as(attn_score)
         attn_prob = self.dropatt(attn_prob)
 
         #### compute attention vector
@@ -354,7 +400,7 @@ class RelLearnableMultiHeadAttn(RelMultiHeadAttn):
                 attn_score.masked_fill_(attn_mask[:,:,:,None], -float('inf'))
 
         # [qlen x klen x bsz x n_head]
-        attn_prob = F.softmax(attn_score, dim=1)
+        attn_prob = F.softmax(fp32_if_bf16(attn_score), dim=1).type_as(attn_score)
         attn_prob = self.dropatt(attn_prob)
 
         #### compute attention vector
@@ -431,9 +477,16 @@ class RelPartialLearnableDecoderLayer(nn.Module):
 
     def forward(self, dec_inp, r, r_w_bias, r_r_bias, dec_attn_mask=None, mems=None):
 
-        output = self.dec_attn(dec_inp, r, r_w_bias, r_r_bias,
-                               attn_mask=dec_attn_mask,
-                               mems=mems)
+        if getattr(self, 'recompute_attn', False) and self.training and torch.is_grad_enabled():
+            # Drop the [qlen x klen x bsz x n_head] score/prob tensors after
+            # forward and rebuild them in backward. checkpoint() restores the
+            # RNG state, so dropatt draws the same mask both times.
+            output = checkpoint(self.dec_attn, dec_inp, r, r_w_bias, r_r_bias,
+                                dec_attn_mask, mems, use_reentrant=False)
+        else:
+            output = self.dec_attn(dec_inp, r, r_w_bias, r_r_bias,
+                                   attn_mask=dec_attn_mask,
+                                   mems=mems)
         try:
             output = self.pos_ff(output)
         except:
@@ -443,8 +496,8 @@ class RelPartialLearnableDecoderLayer(nn.Module):
 
 
 class AdaptiveEmbedding(nn.Module):
-    def __init__(self, n_token, d_embed, d_proj, cutoffs, div_val=1, 
-                 sample_softmax=False):
+    def __init__(self, n_token, d_embed, d_proj, cutoffs, div_val=1,
+                 sample_softmax=False, precompute_eval=False):
         super(AdaptiveEmbedding, self).__init__()
 
         self.n_token = n_token
@@ -458,6 +511,13 @@ class AdaptiveEmbedding(nn.Module):
 
         self.cutoff_ends = [0] + self.cutoffs
 
+        # In eval mode, optionally fold the projections into a single
+        # [n_token x d_proj] table so the lookup becomes one gather. The
+        # table is rebuilt lazily and dropped whenever train() is called or
+        # the weights change (load_state_dict, .to(), .half(), ...).
+        self.precompute_eval = precompute_eval
+        self._eval_table = None
+
         self.emb_layers = nn.ModuleList()
         self.emb_projs = nn.ParameterList()
         if div_val == 1:
@@ -473,31 +533,69 @@ class AdaptiveEmbedding(nn.Module):
                 self.emb_layers.append(nn.Embedding(r_idx-l_idx, d_emb_i))
                 self.emb_projs.append(nn.Parameter(torch.Tensor(d_proj, d_emb_i)))
 
-    def forward(self, inp):
+    def train(self, mode=True):
+        self._eval_table = None
+        return super(AdaptiveEmbedding, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self._eval_table = None
+        return super(AdaptiveEmbedding, self)._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # also called when a parent module's load_state_dict() reaches this one
+        self._eval_table = None
+        return super(AdaptiveEmbedding, self)._load_from_state_dict(*args, **kwargs)
+
+    def __getstate__(self):
+        # Never pickle the derived eval table along with the module.
+        state = self.__dict__.copy()
+        state['_eval_table'] = None
+        return state
+
+    def projected_table(self):
+        """Returns the [n_token x d_proj] table of projected embeddings."""
         if self.div_val == 1:
+            table = self.emb_layers[0].weight
+            if self.d_proj != self.d_embed:
+                table = F.linear(table, self.emb_projs[0])
+            return table
+        return torch.cat([F.linear(self.emb_layers[i].weight, self.emb_projs[i])
+                          for i in range(len(self.cutoffs))], 0)
+
+    def _forward_sorted(self, inp_flat):
+        """Clustered lookup: sort ids by cluster once, run one lookup and
+        projection per cluster on a contiguous slice, then undo the sort with a
+        single gather. Only one host sync (the cluster sizes) per call."""
+        boundaries = inp_flat.new_tensor(self.cutoffs[:-1])
+        cluster = (inp_flat[:, None] >= boundaries[None, :]).sum(1)
+        _, order = torch.sort(cluster)
+        sizes = torch.bincount(cluster, minlength=len(self.cutoffs)).tolist()
+
+        chunks = []
+        for i, inp_i in enumerate(inp_flat.index_select(0, order).split(sizes)):
+            if sizes[i] == 0:
+                continue
+            emb_i = self.emb_layers[i](inp_i - self.cutoff_ends[i])
+            chunks.append(F.linear(emb_i, self.emb_projs[i]))
+        emb_sorted = torch.cat(chunks, 0)
+
+        inv_order = torch.empty_like(order)
+        inv_order[order] = torch.arange(order.size(0), device=order.device)
+        return emb_sorted.index_select(0, inv_order)
+
+    def forward(self, inp):
+        if getattr(self, 'precompute_eval', False) and not self.training:
+            if getattr(self, '_eval_table', None) is None:
+                with torch.no_grad():
+                    self._eval_table = self.projected_table()
+            embed = F.embedding(inp, self._eval_table)
+        elif self.div_val == 1:
             embed = self.emb_layers[0](inp)
             if self.d_proj != self.d_embed:
                 embed  = F.linear(embed, self.emb_projs[0])
         else:
-            param = next(self.parameters())
             inp_flat = inp.view(-1)
-            emb_flat = torch.zeros([inp_flat.size(0), self.d_proj], 
-                dtype=param.dtype, device=param.device)
-            for i in range(len(self.cutoffs)):
-                l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
-
-                mask_i = (inp_flat >= l_idx) & (inp_flat < r_idx)
-                indices_i = mask_i.nonzero().squeeze()
-
-                if indices_i.numel() == 0:
-                    continue
-
-                inp_i = inp_flat.index_select(0, indices_i) - l_idx
-                emb_i = self.emb_layers[i](inp_i)
-                emb_i = F.linear(emb_i, self.emb_projs[i])
-
-                emb_flat.index_copy_(0, indices_i, emb_i)
-
+            emb_flat = self._forward_sorted(inp_flat)
             embed = emb_flat.view(*inp.size(), self.d_proj)
 
         embed.mul_(self.emb_scale)
@@ -511,7 +609,8 @@ class MemTransformerLM(nn.Module):
                  tgt_len=None, ext_len=None, mem_len=None, 
                  cutoffs=[], adapt_inp=False,
                  same_length=False, attn_type=0, clamp_len=-1, 
-                 sample_softmax=-1, fp32_embedding = False, fp32_layernorm = False):
+                 sample_softmax=-1, fp32_embedding = False, fp32_layernorm = False,
+                 sample_alias=False, sample_reuse=1):
         super(MemTransformerLM, self).__init__()
         self.n_token = n_token
 
@@ -567,7 +666,9 @@ class MemTransformerLM(nn.Module):
             if tie_weight:
                 self.out_layer.weight = self.word_emb.weight
             self.tie_weight = tie_weight
-            self.sampler = LogUniformSampler(n_token, sample_softmax)
+            self.sampler = LogUniformSampler(n_token, sample_softmax,
+                                             use_alias=sample_alias,
+                                             resample_every=sample_reuse)
 
         # use adaptive softmax (including standard softmax)
         else:
@@ -593,6 +694,39 @@ class MemTransformerLM(nn.Module):
     def backward_compatible(self):
         self.sample_softmax = -1
 
+    def set_recompute(self, policy='none', every=1):
+        """Trades compute for memory by recomputing decoder layer activations
+        in backward instead of storing them. Only used with attn_type 0.
+
+        policy: 'none', 'all' (every layer), 'every_k' (layers 0, k, 2k, ...
+            with k=`every`) or 'attn' (only the attention sublayer of each layer,
+            which holds the quadratic score/prob tensors)
+        """
+        assert policy in ('none', 'all', 'every_k', 'attn'), f'unknown recompute policy {policy}'
+        assert every >= 1, 'recompute interval must be positive'
+        self.recompute = policy
+        self.recompute_every = every
+        for layer in self.layers:
+            layer.recompute_attn = policy == 'attn'
+
+    def set_fused_ff(self, fused=True, chunk_size=0):
+        """Switches every PositionwiseFF to the fused implementation. With
+        chunk_size > 0, inference runs the FFN in sequence chunks of that size."""
+        for module in self.modules():
+            if isinstance(module, PositionwiseFF):
+                module.fused = fused
+                module.chunk_size = chunk_size
+
+    def _recompute_layer(self, i):
+        policy = getattr(self, 'recompute', 'none')
+        if not self.training or not torch.is_grad_enabled():
+            return False
+        if policy == 'all':
+            return True
+        if policy == 'every_k':
+            return i % self.recompute_every == 0
+        return False
+
     def _create_params(self):
         if self.attn_type == 0: # default attention
             self.pos_emb = PositionalEmbedding(self.d_model)
@@ -686,8 +820,15 @@ class MemTransformerLM(nn.Module):
             for i, layer in enumerate(self.layers):
                 mems_i = None if mems is None else mems[i]
                 #print("layer ", i, ": ", mems_i.dtype, layer)
-                core_out = layer(core_out, pos_emb, self.r_w_bias,
-                        self.r_r_bias, dec_attn_mask=dec_attn_mask, mems=mems_i)
+                if self._recompute_layer(i):
+                    # RNG state is preserved by checkpoint(), so dropout masks
+                    # match between the forward and the recomputation.
+                    core_out = checkpoint(layer, core_out, pos_emb, self.r_w_bias,
+                                          self.r_r_bias, dec_attn_mask, mems_i,
+                                          use_reentrant=False)
+                else:
+                    core_out = layer(core_out, pos_emb, self.r_w_bias,
+                            self.r_r_bias, dec_attn_mask=dec_attn_mask, mems=mems_i)
                 hids.append(core_out)
         elif self.attn_type == 1: # learnable
             core_out = self.drop(word_emb)
@@ -763,7 +904,7 @@ class MemTransformerLM(nn.Module):
             assert self.tie_weight
             logit = sample_logits(self.word_emb,
                 self.out_layer.bias, target, pred_hid, self.sampler)
-            loss = -F.log_softmax(logit, -1)[:, :, 0]
+            loss = -F.log_softmax(fp32_if_bf16(logit), -1)[:, :, 0]
         else:
             loss = self.crit(pred_hid.view(-1, pred_hid.size(-1)), target.view(-1))
             loss = loss.view(tgt_len, -1)
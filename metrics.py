@@ -0,0 +1,160 @@
+"""Buffered metrics writer for the training loop.
+
+MetricsWriter has the add_scalar / add_histogram / add_text methods of tensorboardX's
+SummaryWriter, but they only append to an in-memory buffer; a background thread writes
+the buffer out every flush_secs, so the training loop never builds protobufs or touches
+files. Scalars may be 0-dim tensors (also on GPU): they are converted in the background
+thread, so logging them does not force a host sync either.
+
+Without tensorboardX (or with backend='jsonl') the records go to {logdir}/metrics-{rank}.jsonl,
+one JSON object per line.
+
+With aggregate=True every rank buffers its scalars and gather() (which all ranks must call,
+at the same point of the training loop) collects the scalars logged since the last gather
+on rank 0 in one all_gather_object. Rank 0 then also writes {tag}/rank_min, {tag}/rank_max
+and {tag}/rank_mean over the ranks that logged the tag at that step. Without aggregate,
+gather() is a no-op and only rank 0 needs a writer.
+
+    writer = MetricsWriter(logdir, rank=rank, world_size=world_size, aggregate=True)
+    writer.add_scalar('times/step', step_ms, token_count)
+    writer.gather()  # on all ranks, e.g. at every log interval
+    writer.close()
+"""
+import json
+import os
+import threading
+import time
+
+import torch
+import torch.distributed as dist
+
+
+def _to_python(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().float().cpu().tolist()
+    return value
+
+
+class _JSONLWriter:
+    """The SummaryWriter subset MetricsWriter uses, writing JSON lines instead of events."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def add_scalar(self, tag, value, step, walltime):
+        self._write({'tag': tag, 'value': value, 'step': step, 'wall_time': walltime})
+
+    def add_histogram(self, tag, values, step, walltime):
+        self._write({'tag': tag, 'values': values, 'step': step, 'wall_time': walltime})
+
+    def add_text(self, tag, text, step, walltime):
+        self._write({'tag': tag, 'text': text, 'step': step, 'wall_time': walltime})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MetricsWriter:
+    """Buffers metrics and writes them from a background thread, see module docstring.
+    Ranks other than 0 only buffer scalars for gather() and write nothing themselves."""
+
+    def __init__(self, logdir, flush_secs=10., rank=0, world_size=1, aggregate=False, backend='auto'):
+        assert backend in ('auto', 'tensorboard', 'jsonl'), backend
+        self.rank = rank
+        self.aggregate = aggregate and world_size > 1
+        self.flush_secs = flush_secs
+        self.buffer = []  # (kind, tag, value, step, walltime)
+        self.gathered = []  # scalars of this rank since the last gather()
+        self.lock = threading.Lock()
+        self.writer = None
+        if rank == 0:
+            if backend != 'jsonl':
+                try:
+                    from tensorboardX import SummaryWriter
+                    self.writer = SummaryWriter(logdir)
+                except ImportError:
+                    if backend == 'tensorboard':
+                        raise
+            if self.writer is None:
+                os.makedirs(logdir, exist_ok=True)
+                self.writer = _JSONLWriter(os.path.join(logdir, f'metrics-{rank}.jsonl'))
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+            self.thread.start()
+
+    def add_scalar(self, tag, value, step=None):
+        record = ('scalar', tag, value, step, time.time())
+        with self.lock:
+            if self.writer is not None:
+                self.buffer.append(record)
+            if self.aggregate:
+                self.gathered.append(record)
+
+    def add_histogram(self, tag, values, step=None):
+        if self.writer is not None:
+            with self.lock:
+                self.buffer.append(('histogram', tag, values, step, time.time()))
+
+    def add_text(self, tag, text, step=None):
+        if self.writer is not None:
+            with self.lock:
+                self.buffer.append(('text', tag, text, step, time.time()))
+
+    def gather(self):
+        """Collective: sends the scalars logged since the last call to rank 0, which writes
+        their min/max/mean over ranks."""
+        if not self.aggregate:
+            return
+        with self.lock:
+            records, self.gathered = self.gathered, []
+        # tensors are converted here so that only plain Python objects are pickled
+        mine = [(tag, _to_python(value), step) for _, tag, value, step, _ in records]
+        everyone = [None] * dist.get_world_size()
+        dist.all_gather_object(everyone, mine)
+        if self.writer is None:
+            return
+        by_key = {}
+        for rank_records in everyone:
+            for tag, value, step in rank_records:
+                by_key.setdefault((tag, step), []).append(value)
+        now = time.time()
+        with self.lock:
+            for (tag, step), values in by_key.items():
+                if len(values) > 1:
+                    self.buffer.append(('scalar', f'{tag}/rank_min', min(values), step, now))
+                    self.buffer.append(('scalar', f'{tag}/rank_max', max(values), step, now))
+                    self.buffer.append(('scalar', f'{tag}/rank_mean', sum(values) / len(values), step, now))
+
+    def _run(self):
+        while not self.stop.wait(self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        """Writes everything buffered so far (called by the background thread)."""
+        if self.writer is None:
+            return
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        for kind, tag, value, step, walltime in records:
+            if kind == 'scalar':
+                self.writer.add_scalar(tag, _to_python(value), step, walltime)
+            elif kind == 'histogram':
+                values = _to_python(value) if isinstance(self.writer, _JSONLWriter) else value
+                self.writer.add_histogram(tag, values, step, walltime=walltime)
+            else:
+                self.writer.add_text(tag, value, step, walltime)
+        self.writer.flush()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+        self.writer.close()
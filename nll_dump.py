@@ -0,0 +1,158 @@
+"""Per-token NLL dumps from evaluation, and their analysis.
+
+A dump is two files:
+  {path}      packed records of (nll float16, token id int32), 6 bytes per scored token,
+              batch after batch, each batch in (seq_len, batch_size) row-major order
+  {path}.json batch_size, tgt_len, mem_len, and per batch its seq_len and the memory
+              length the batch was evaluated with
+
+NLLDumpWriter keeps the per-token losses on the device and copies them out every
+flush_every batches; the file writes happen in a background thread, so the evaluation loop
+only pays for a float16 cast and an occasional device-to-host copy.
+
+python nll_dump.py dump-valid.nll                      # summary and bucketed tables
+python nll_dump.py dump-valid.nll --cutoffs 20000,40000,200000 --json out.json
+"""
+import argparse
+import concurrent.futures
+import json
+import math
+
+import numpy as np
+import torch
+
+DUMP_DTYPE = np.dtype([('nll', '<f2'), ('tok', '<i4')])
+
+
+class NLLDumpWriter:
+    """Streams per-token losses of an evaluation to path (see module docstring)."""
+
+    def __init__(self, path, meta: dict = None, flush_every=64):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.flush_every = flush_every
+        self.file = open(path, 'wb')
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.seq_lens = []
+        self.mem_lens = []
+        self.batch_size = None
+        self.n_tokens = 0
+
+    def add(self, nll, target, mem_len=0):
+        """nll and target are (seq_len, batch_size); mem_len is the length of the memory the
+        batch attended to."""
+        self.batch_size = nll.size(1)
+        self.pending.append((nll.detach().view(-1).half(), target.reshape(-1).int()))
+        self.seq_lens.append(nll.size(0))
+        self.mem_lens.append(mem_len)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        nll = torch.cat([p[0] for p in self.pending]).cpu().numpy()
+        tok = torch.cat([p[1] for p in self.pending]).cpu().numpy()
+        self.pending = []
+        records = np.empty(len(nll), dtype=DUMP_DTYPE)
+        records['nll'] = nll
+        records['tok'] = tok
+        self.n_tokens += len(records)
+        self.pool.submit(self.file.write, records.tobytes())
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown(wait=True)
+        self.file.close()
+        meta = dict(self.meta, batch_size=self.batch_size, n_tokens=self.n_tokens,
+                    seq_lens=self.seq_lens, mem_lens=self.mem_lens)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+
+def load_dump(path):
+    """Returns (records, meta, pos, context): the memory-mapped records, the metadata, and
+    for every token its position within the segment and the number of tokens it could
+    attend to (memory + earlier positions of the segment + itself)."""
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    records = np.memmap(path, dtype=DUMP_DTYPE, mode='r')
+    seq_lens = np.asarray(meta['seq_lens'], dtype=np.int64)
+    mem_lens = np.asarray(meta['mem_lens'], dtype=np.int64)
+    sizes = seq_lens * meta['batch_size']
+    batch_of = np.repeat(np.arange(len(sizes)), sizes)
+    start_of = np.concatenate([[0], np.cumsum(sizes)[:-1]])[batch_of]
+    pos = (np.arange(len(batch_of)) - start_of) // meta['batch_size']
+    context = pos + 1 + mem_lens[batch_of]
+    return records, meta, pos, context
+
+
+def bucket_table(nll, keys, labels):
+    """Rows of (label, tokens, mean nll, ppl) for each bucket index in keys."""
+    counts = np.bincount(keys, minlength=len(labels))
+    sums = np.bincount(keys, weights=nll, minlength=len(labels))
+    rows = []
+    for label, count, total in zip(labels, counts, sums):
+        if count:
+            rows.append((label, int(count), total / count, math.exp(min(total / count, 700))))
+    return rows
+
+
+def analyze(path, cutoffs=(), n_position_buckets=8):
+    records, meta, pos, context = load_dump(path)
+    nll = records['nll'].astype(np.float64)
+    tok = records['tok']
+    tables = {}
+
+    # token id buckets; ids in wt103-style vocabs are sorted by frequency
+    if cutoffs:
+        edges = list(cutoffs)
+        labels = [f'id < {edges[0]}'] + [f'{a} <= id < {b}' for a, b in zip(edges, edges[1:])] + [f'id >= {edges[-1]}']
+        tables['token id'] = bucket_table(nll, np.digitize(tok, edges), labels)
+
+    # frequency of the token within the evaluated data, decades
+    freq = np.bincount(tok)[tok]
+    decade = np.floor(np.log10(freq)).astype(np.int64)
+    tables['frequency in split'] = bucket_table(
+        nll, decade, [f'{10 ** d}-{10 ** (d + 1) - 1}' for d in range(decade.max() + 1)])
+
+    # position within the segment
+    tgt_len = max(meta['seq_lens'])
+    width = max(1, math.ceil(tgt_len / n_position_buckets))
+    tables['position in segment'] = bucket_table(
+        nll, pos // width, [f'{b * width}-{min(tgt_len, (b + 1) * width) - 1}'
+                            for b in range(math.ceil(tgt_len / width))])
+
+    # attainable context (memory + position), powers of two
+    log2 = np.floor(np.log2(context)).astype(np.int64)
+    tables['context length'] = bucket_table(
+        nll, log2, [f'{2 ** b}-{2 ** (b + 1) - 1}' for b in range(log2.max() + 1)])
+
+    summary = {'tokens': len(nll), 'loss': nll.mean(), 'ppl': math.exp(nll.mean())}
+    return summary, tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bucketed metrics of a per-token NLL dump')
+    parser.add_argument('path', help='dump written by eval.py --dump_nll')
+    parser.add_argument('--cutoffs', type=str, default='',
+                        help='comma-separated token id bucket edges, e.g. the adaptive softmax cutoffs')
+    parser.add_argument('--position_buckets', type=int, default=8)
+    parser.add_argument('--json', type=str, default='', help='also write the tables to this file')
+    args = parser.parse_args()
+
+    cutoffs = [int(c) for c in args.cutoffs.split(',')] if args.cutoffs else []
+    summary, tables = analyze(args.path, cutoffs, args.position_buckets)
+    print(f'{summary["tokens"]} tokens | loss {summary["loss"]:.4f} | ppl {summary["ppl"]:.3f}')
+    for name, rows in tables.items():
+        print(f'\n{name:<24} | {"tokens":>10} | {"loss":>7} | {"ppl":>10}')
+        for label, count, loss, ppl in rows:
+            print(f'{label:<24} | {count:10d} | {loss:7.4f} | {ppl:10.2f}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'summary': summary, 'tables': tables}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Per-phase step profiler for the training loop.
+
+Every phase duration goes into a fixed-size log-bucketed histogram (5% wide buckets from
+1us to ~35min), so memory stays constant however long the run is and p50/p90/p99 are
+available at any time, accurate to the bucket width. summary() returns one line with the
+percentiles of each phase since the last summary and resets the histograms.
+
+On GPU, host timings only show how long it took to queue the kernels. With cuda_events=True
+each phase also records a pair of CUDA events; they are resolved at summary time (when the
+host has synchronized anyway) and the GPU time replaces the host time in the histograms.
+
+    profiler = StepProfiler(cuda_events=True)
+    for data, target, seq_len in profiler.iter('data', tr_iter):
+        with profiler.phase('forward'):
+            ...
+        profiler.step_done()
+    line, stats = profiler.summary()
+"""
+import contextlib
+import math
+import time
+
+import torch
+
+
+class Histogram:
+    """Counts of values (ms) in log-spaced buckets; bounded memory, approximate percentiles."""
+
+    MIN_MS = 1e-3
+    RATIO = 1.05
+    N_BUCKETS = 440
+
+    def __init__(self):
+        self.counts = [0] * self.N_BUCKETS
+        self.n = 0
+        self.total = 0.
+
+    def add(self, ms):
+        if ms <= self.MIN_MS:
+            i = 0
+        else:
+            i = min(self.N_BUCKETS - 1, int(math.log(ms / self.MIN_MS) / math.log(self.RATIO)))
+        self.counts[i] += 1
+        self.n += 1
+        self.total += ms
+
+    def percentile(self, q):
+        """Geometric middle of the bucket holding the q-th percentile (0 < q <= 100)."""
+        if self.n == 0:
+            return 0.
+        rank = q / 100 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.MIN_MS * self.RATIO ** (i + 0.5)
+        return self.MIN_MS * self.RATIO ** self.N_BUCKETS
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else 0.
+
+
+class StepProfiler:
+    """Times named phases of training steps, see module docstring. With enabled=False all
+    methods are no-ops."""
+
+    def __init__(self, enabled=True, cuda_events=False):
+        self.enabled = enabled
+        self.cuda_events = cuda_events and torch.cuda.is_available()
+        self.hists = {}
+        self.pending_events = []  # (name, start event, end event)
+        self.step_start = None
+
+    def add(self, name, ms):
+        """Records a duration measured elsewhere (e.g. communication wait inside backward)."""
+        if self.enabled:
+            self.hists.setdefault(name, Histogram()).add(ms)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.cuda_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda_events:
+                end_event.record()
+                self.pending_events.append((name, start_event, end_event))
+            else:
+                self.add(name, 1000 * (time.perf_counter() - start))
+
+    def iter(self, name, iterable):
+        """Yields from iterable, timing each next() as phase `name`."""
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def step_done(self):
+        """Marks the end of a step; wall time between calls goes into the 'step' histogram."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.step_start is not None:
+            self.add('step', 1000 * (now - self.step_start))
+        self.step_start = now
+
+    def _resolve_events(self):
+        if self.pending_events:
+            self.pending_events[-1][2].synchronize()
+            for name, start_event, end_event in self.pending_events:
+                self.add(name, start_event.elapsed_time(end_event))
+            self.pending_events = []
+
+    def percentiles(self):
+        """{phase: (p50, p90, p99, mean)} since the last summary."""
+        self._resolve_events()
+        return {name: (h.percentile(50), h.percentile(90), h.percentile(99), h.mean)
+                for name, h in self.hists.items()}
+
+    def summary(self):
+        """Returns (one line of p50/p90/p99 in ms per phase, percentiles()) and resets the
+        histograms."""
+        if not self.enabled:
+            return '', {}
+        stats = self.percentiles()
+        self.hists = {}
+        parts = [f'{name} {p50:.1f}/{p90:.1f}/{p99:.1f}' for name, (p50, p90, p99, _) in stats.items()]
+        return '| profile ms p50/p90/p99 | ' + ' | '.join(parts), stats
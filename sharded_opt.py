@@ -0,0 +1,314 @@
+"""ZeRO-1 style optimizer sharding for distributed training.
+
+Every rank keeps the full model, but fp32 master weights and optimizer state (Adam/LAMB
+moments) only for the parameters it owns, so that memory is divided by the world size.
+A step is: reduce-scatter of the gradients, an optimizer step on the owned shard, and an
+all-gather of the updated parameters.
+
+Parameters are assigned to ranks whole, so per-parameter optimizer math such as LAMB's
+trust ratio (||w|| / ||adam_step|| of each layer) is exactly the same as without sharding.
+
+python sharded_opt.py  # 2-process gloo check against the unsharded optimizer
+"""
+import torch
+import torch.distributed as dist
+
+from loss_scaler import DynamicLossScaler, LossScaler
+
+
+def partition_params(params, world_size):
+    """Assigns each parameter to a rank, largest first onto the least loaded rank.
+    Returns one list of parameters per rank, each in the original order."""
+    sizes = [0] * world_size
+    owner = [0] * len(params)
+    for i in sorted(range(len(params)), key=lambda i: -params[i].numel()):
+        rank = sizes.index(min(sizes))
+        owner[i] = rank
+        sizes[rank] += params[i].numel()
+    return [[p for p, o in zip(params, owner) if o == rank] for rank in range(world_size)]
+
+
+class ShardedOptimizer(object):
+    """
+    Wraps an existing optimizer the way :class:`FP16_Optimizer` does, and exposes the same
+    interface (``backward``, ``update_master_grads``, ``clip_master_grads``, ``step``,
+    ``overflow``, ``param_groups``), so train.py drives both the same way.
+
+    ``init_optimizer`` must be built over the model's parameters after they were moved to
+    their final device and dtype (fp32, or fp16 under :class:`FP16_Module`).  Its param groups
+    are rewritten in place to hold only this rank's parameters (fp32 master copies for fp16
+    models), so lr schedulers attached to it keep working.
+
+    The model parameters are re-pointed into one flat buffer, padded so every rank's slice has
+    the same size, which the all-gather writes into directly.  Gradients are averaged across
+    ranks here, so the model must not all-reduce them itself (run DDP under ``no_sync()``).
+
+    Loss scaling (static or dynamic) works as in :class:`FP16_Optimizer`; the overflow check
+    costs one all-reduce of a flag.
+
+    ``state_dict()`` only holds this rank's shard; every rank must save its own.
+    """
+
+    def __init__(self,
+                 init_optimizer,
+                 static_loss_scale=1.0,
+                 dynamic_loss_scale=False,
+                 dynamic_loss_args=None,
+                 verbose=False):
+        self.optimizer = init_optimizer
+        self.world_size = dist.get_world_size()
+        self.rank = dist.get_rank()
+        self.verbose = verbose
+
+        params, group_of = [], {}
+        for i, param_group in enumerate(self.optimizer.param_groups):
+            for param in param_group['params']:
+                if param.requires_grad:
+                    params.append(param)
+                    group_of[param] = i
+        assert len({(p.dtype, p.device) for p in params}) == 1, \
+            'ShardedOptimizer needs all parameters on one device with one dtype'
+        self.params = params
+        self.shards = partition_params(params, self.world_size)
+        self.shard_numel = max(sum(p.numel() for p in shard) for shard in self.shards)
+        self.maybe_print(f'ShardedOptimizer: rank {self.rank} owns {len(self.shards[self.rank])} '
+                         f'of {len(params)} params, {self.shard_numel} elements per rank')
+
+        # model params become views into param_buffer, in rank order
+        self.param_buffer = params[0].new_zeros(self.world_size * self.shard_numel)
+        self.param_chunks = list(self.param_buffer.chunk(self.world_size))
+        self.grad_buffer = torch.zeros(self.world_size * self.shard_numel,
+                                       dtype=torch.float32, device=params[0].device)
+        self.grad_chunks = list(self.grad_buffer.chunk(self.world_size))
+        self.grad_shard = torch.zeros_like(self.grad_chunks[0])
+        for rank, shard in enumerate(self.shards):
+            offset = 0
+            for param in shard:
+                view = self.param_chunks[rank][offset:offset + param.numel()].view_as(param)
+                view.copy_(param.data)
+                param.data = view
+                offset += param.numel()
+
+        # master params: the model params themselves when fp32, otherwise fp32 copies
+        self.model_params = self.shards[self.rank]
+        self.master_params = []
+        for param_group in self.optimizer.param_groups:
+            param_group['params'] = []
+        for param in self.model_params:
+            if param.dtype == torch.float32:
+                master_param = param
+            else:
+                master_param = param.detach().clone().float()
+                master_param.requires_grad = True
+            self.master_params.append(master_param)
+            self.optimizer.param_groups[group_of[param]]['params'].append(master_param)
+            if param in self.optimizer.state:
+                self.optimizer.state[master_param] = self.optimizer.state.pop(param)
+        owned = set(map(id, self.model_params))
+        for param in params:
+            if id(param) not in owned:
+                self.optimizer.state.pop(param, None)
+
+        if dynamic_loss_scale:
+            self.dynamic_loss_scale = True
+            if dynamic_loss_args is not None:
+                self.loss_scaler = DynamicLossScaler(**dynamic_loss_args)
+            else:
+                self.loss_scaler = DynamicLossScaler()
+        else:
+            self.dynamic_loss_scale = False
+            self.loss_scaler = LossScaler(static_loss_scale)
+
+        self.overflow = False
+        self.master_grads_ready = False
+
+    def maybe_print(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def zero_grad(self, set_grads_to_None=False):
+        """Zeroes the model grads (the master grads are overwritten by every reduction)."""
+        for param in self.params:
+            if set_grads_to_None:
+                param.grad = None
+            elif param.grad is not None:
+                # owned fp32 params' grads are views into grad_shard
+                if param.grad.grad_fn is not None:
+                    param.grad.detach_()
+                param.grad.zero_()
+
+    def _reduce_scatter_grads(self):
+        """Averages the model grads across ranks into grad_shard, this rank's slice."""
+        for rank, shard in enumerate(self.shards):
+            offset = 0
+            for param in shard:
+                dst = self.grad_chunks[rank][offset:offset + param.numel()]
+                if param.grad is None:
+                    dst.zero_()
+                else:
+                    dst.copy_(param.grad.detach().view(-1))
+                offset += param.numel()
+        self.grad_buffer.div_(self.world_size * self.loss_scale)
+        try:
+            dist.reduce_scatter(self.grad_shard, self.grad_chunks)
+        except RuntimeError:
+            # backends without reduce_scatter (gloo in older pytorch)
+            dist.all_reduce(self.grad_buffer)
+            self.grad_shard.copy_(self.grad_chunks[self.rank])
+
+    def _all_gather_params(self):
+        for model_param, master_param in zip(self.model_params, self.master_params):
+            if master_param is not model_param:
+                model_param.data.copy_(master_param.data)
+        # the local chunk is also an output, so send a copy of it
+        dist.all_gather(self.param_chunks, self.param_chunks[self.rank].clone())
+
+    def backward(self, loss, update_master_grads=True, retain_graph=False):
+        """Scales the loss and backpropagates, see :meth:`FP16_Optimizer.backward`."""
+        self.loss_scaler.backward(loss.float(), retain_graph=retain_graph)
+        if update_master_grads:
+            self.update_master_grads()
+
+    def update_master_grads(self):
+        """Reduce-scatters the model grads, unscaled, into the master grads of the owned
+        shard.  Called by :meth:`step` if it wasn't called since the last step."""
+        self._reduce_scatter_grads()
+        if self.dynamic_loss_scale:
+            overflow = DynamicLossScaler._has_inf_or_nan_multi([self.grad_shard])
+            flag = torch.tensor([float(overflow)], device=self.grad_shard.device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            self.overflow = bool(flag.item())
+        offset = 0
+        for master_param in self.master_params:
+            master_param.grad = self.grad_shard[offset:offset + master_param.numel()].view_as(master_param)
+            offset += master_param.numel()
+        self.master_grads_ready = True
+
+    def clip_master_grads(self, max_norm, norm_type=2):
+        """Clips the master grads by their global 2-norm, computed from per-shard squared
+        norms with one all-reduce.  The norm stays on the device; returns it, or -1 on
+        overflow."""
+        assert norm_type == 2, 'only the 2-norm is supported'
+        if not self.master_grads_ready:
+            self.update_master_grads()
+        if self.overflow:
+            return -1
+        total_norm = self.grad_shard.pow(2).sum().view(1)
+        dist.all_reduce(total_norm)
+        total_norm = total_norm.sqrt()
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        self.grad_shard.mul_(clip_coef)
+        return total_norm
+
+    def step(self, closure=None):
+        assert closure is None, 'closures are not supported'
+        if not self.master_grads_ready:
+            self.update_master_grads()
+        self.master_grads_ready = False
+        self.loss_scaler.update_scale(self.overflow)
+        if self.overflow:
+            self.maybe_print(f'OVERFLOW! Skipping step. Attempted loss scale: {self.loss_scale}, '
+                             f'reducing to {self.loss_scaler.loss_scale}')
+            return
+        self.optimizer.step()
+        self._all_gather_params()
+
+    def state_dict(self):
+        """Returns this rank's shard: optimizer state and fp32 master params of the owned
+        parameters, plus the loss scaler."""
+        state_dict = {}
+        state_dict['rank'] = self.rank
+        state_dict['world_size'] = self.world_size
+        state_dict['loss_scaler'] = self.loss_scaler
+        state_dict['dynamic_loss_scale'] = self.dynamic_loss_scale
+        state_dict['overflow'] = self.overflow
+        state_dict['optimizer_state_dict'] = self.optimizer.state_dict()
+        state_dict['fp32_master_params'] = self.master_params
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        """Loads a shard saved by the same rank of a run with the same world size and model."""
+        assert (state_dict['rank'], state_dict['world_size']) == (self.rank, self.world_size), \
+            'optimizer shard was saved by a different rank or world size'
+        self.loss_scaler = state_dict['loss_scaler']
+        self.dynamic_loss_scale = state_dict['dynamic_loss_scale']
+        self.overflow = state_dict['overflow']
+        self.optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+        for current, saved in zip(self.master_params, state_dict['fp32_master_params']):
+            current.data.copy_(saved.data)
+
+    # Promote loss_scale, state and param_groups as FP16_Optimizer does
+    def _get_loss_scale(self):
+        return self.loss_scaler.loss_scale
+
+    def _set_loss_scale(self, value):
+        self.loss_scaler.cur_scale = value
+
+    loss_scale = property(_get_loss_scale, _set_loss_scale)
+
+    def _get_state(self):
+        return self.optimizer.state
+
+    def _set_state(self, value):
+        self.optimizer.state = value
+
+    state = property(_get_state, _set_state)
+
+    def _get_param_groups(self):
+        return self.optimizer.param_groups
+
+    def _set_param_groups(self, value):
+        self.optimizer.param_groups = value
+
+    param_groups = property(_get_param_groups, _set_param_groups)
+
+
+def _check_worker(rank, world_size, port, results):
+    import copy
+    import os
+    from pytorch_lamb import Lamb
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Embedding(50, 16), torch.nn.Linear(16, 64),
+                                torch.nn.ReLU(), torch.nn.Linear(64, 50))
+    reference = copy.deepcopy(model)
+    ref_opt = Lamb(reference.parameters(), lr=0.02, weight_decay=0.01)
+    optimizer = ShardedOptimizer(Lamb(model.parameters(), lr=0.02, weight_decay=0.01))
+    state_numel = lambda opt: sum(t.numel() for s in opt.state.values()
+                                  for t in s.values() if torch.is_tensor(t) and t.dim() > 0)
+
+    for step in range(5):
+        data = torch.randint(0, 50, (world_size, 8, 12), generator=torch.Generator().manual_seed(step))
+        # each rank sees its slice of the batch; the reference sees all of it
+        loss = torch.nn.functional.cross_entropy(model(data[rank]).view(-1, 50), data[rank].view(-1))
+        optimizer.zero_grad()
+        optimizer.backward(loss)
+        optimizer.clip_master_grads(0.5)
+        optimizer.step()
+
+        ref_loss = torch.nn.functional.cross_entropy(reference(data).view(-1, 50), data.view(-1))
+        ref_opt.zero_grad()
+        ref_loss.backward()
+        torch.nn.utils.clip_grad_norm_(reference.parameters(), 0.5)
+        ref_opt.step()
+
+    diff = max((p - q).abs().max().item() for p, q in zip(model.parameters(), reference.parameters()))
+    results[rank] = (diff, state_numel(optimizer), state_numel(ref_opt))
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import torch.multiprocessing as mp
+
+    world_size = 2
+    results = mp.Manager().dict()
+    mp.spawn(_check_worker, args=(world_size, 29511, results), nprocs=world_size)
+    for rank in range(world_size):
+        diff, numel, ref_numel = results[rank]
+        print(f'rank {rank}: max |param diff| vs unsharded Lamb {diff:.2e}, '
+              f'optimizer state {numel} of {ref_numel} elements')
+        assert diff < 1e-5
@@ -2,6 +2,7 @@
 #
 import argparse
 import collections
+import contextlib
 import datetime
 import itertools
 import logging
@@ -10,9 +11,13 @@ import os
 import sys
 import time
 import warnings
-from collections import OrderedDict
 
-from fp16_opt import FP16_Module, FP16_Optimizer
+from fp16_opt import BF16_Module, FP16_Module, FP16_Optimizer
+from sharded_opt import ShardedOptimizer
+from comm_hooks import GradCommState, ddp_comm_hook, reduce_gradients
+from checkpoint import AsyncCheckpointWriter
+from profiler import StepProfiler
+from metrics import MetricsWriter
 
 import numpy as np
 import pytz
@@ -21,13 +26,13 @@ import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import tqdm
-from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
 from data_utils import get_lm_corpus
 from mem_transformer import MemTransformerLM
+from utils.data_parallel import BucketedDistributedDataParallel
 from lr_finder import LRFinder
-from pytorch_lamb import Lamb, log_lamb_rs
+from pytorch_lamb import Lamb
 from eval import evaluate
 
 import util
@@ -94,6 +99,12 @@ parser.add_argument('--clip_nonemb', action='store_true',
 parser.add_argument('--max_tokens', type=int, default=1.8e9, help='upper epoch limit affecting LR schedule')
 parser.add_argument('--batch_size', type=int, default=60,
                     help='batch size')
+parser.add_argument('--eval_batch_size', type=int, default=0,
+                    help='batch size of the valid/test iterators (default: 2 * batch_size); '
+                         'see eval.py --autotune')
+parser.add_argument('--grad_accum_steps', type=int, default=1,
+                    help='accumulate gradients over this many micro-batches of '
+                         'batch_size per optimizer step, each with its own mems')
 parser.add_argument('--tgt_len', type=int, default=70,
                     help='number of tokens to predict')
 parser.add_argument('--eval_tgt_len', type=int, default=50,
@@ -145,6 +156,19 @@ parser.add_argument('--max_eval_steps', type=int, default=-1,
                     help='max eval steps')
 parser.add_argument('--sample_softmax', type=int, default=-1,
                     help='number of samples in sampled softmax')
+parser.add_argument('--sample_alias', action='store_true',
+                    help='draw sampled softmax negatives on device with the alias method')
+parser.add_argument('--sample_reuse', type=int, default=1,
+                    help='reuse sampled softmax negatives for this many micro-batches (sample() calls; '
+                         'with --grad_accum_steps, several per optimizer step)')
+parser.add_argument('--recompute', type=str, default='none',
+                    choices=['none', 'all', 'every_k', 'attn'],
+                    help='recompute decoder layer activations in backward to save memory: '
+                         'all layers, every k-th layer or only the attention sublayers')
+parser.add_argument('--recompute_every', type=int, default=2,
+                    help='k for --recompute=every_k')
+parser.add_argument('--fused_ff', action='store_true',
+                    help='use the fused position-wise feed-forward implementation')
 parser.add_argument('--patience', type=int, default=0,
                     help='patience')
 parser.add_argument('--finetune_v2', action='store_true',
@@ -157,6 +181,12 @@ parser.add_argument('--bpe', action='store_true', default=False,
                     help="Use BPE instead of traditional vocabulary.")
 parser.add_argument('--fp16', action='store_true',
                     help='Run in pseudo-fp16 mode (fp16 storage fp32 math).')
+parser.add_argument('--bf16', action='store_true',
+                    help='Run under bfloat16 autocast with fp32 master weights and no '
+                         'loss scaling. Works on CPU.')
+parser.add_argument('--shard_optimizer', action='store_true',
+                    help='partition optimizer state and fp32 master weights across ranks '
+                         '(ZeRO-1): reduce-scatter grads, step the owned shard, all-gather params')
 parser.add_argument('--static_loss_scale', type=float, default=1,
                     help='Static loss scale, positive power of 2 values can '
                          'improve fp16 convergence.')
@@ -164,8 +194,50 @@ parser.add_argument('--dynamic_loss_scale', action='store_true',
                     help='Use dynamic loss scaling.  If supplied, this argument'
                          ' supersedes --static-loss-scale.')
 
+parser.add_argument('--no_host_sync', action='store_true',
+                    help='avoid host-device syncs in the training loop: compute the global '
+                         'batch size once, keep the running loss on device until log time '
+                         'and clip gradients without reading the norm back')
+parser.add_argument('--debug_asserts', action='store_true',
+                    help='check data/target alignment every step (forces a host sync)')
+parser.add_argument('--trace_syncs', type=int, default=0,
+                    help='log the number of host syncs (reads of GPU tensors) in each of the first N steps')
+parser.add_argument('--profile', action='store_true',
+                    help='time the phases of every step and log their p50/p90/p99 every log_interval')
+parser.add_argument('--profile_cuda_events', action='store_true',
+                    help='with --profile on GPU, time phases with CUDA events (GPU time) instead of host time')
+parser.add_argument('--metrics_flush_secs', type=float, default=10,
+                    help='how often the background thread writes buffered metrics to the logdir')
+parser.add_argument('--metrics_aggregate', action='store_true',
+                    help='gather the scalars of all ranks every log_interval and log their min/max/mean')
+parser.add_argument('--metrics_backend', type=str, default='auto', choices=['auto', 'tensorboard', 'jsonl'],
+                    help='auto: TensorBoard events if tensorboardX is installed, else metrics-0.jsonl')
+
 # distributed training flags
+parser.add_argument('--async_checkpoint', action='store_true',
+                    help='snapshot checkpoints to host memory and write them in a background thread')
+parser.add_argument('--checkpoint_max_pending', type=int, default=1,
+                    help='max checkpoint snapshots held in memory waiting to be written')
+parser.add_argument('--sharded_checkpoint', action='store_true',
+                    help='save the model as model-{suffix}.shards/: every rank writes part of the '
+                         'tensors, loading memory-maps them (see checkpoint.py)')
 parser.add_argument('--local', action='store_true', help='Run local training instead of distrbuted.')
+parser.add_argument('--local_procs', type=int, default=0,
+                    help='single-node multi-process training: launch this many worker processes, '
+                         'each with a persistent replica and its own mems (gloo on CPU)')
+parser.add_argument('--bucket_cap_mb', type=int, default=25,
+                    help='gradient bucket size for all-reduce overlapped with backward on CPU')
+parser.add_argument('--grad_comm', type=str, default='ddp', choices=['ddp', 'flat', 'hierarchical'],
+                    help='gradient reduction: the data parallel wrapper\'s own all-reduce, or '
+                         'comm_hooks with one level (flat) or intra-node then inter-node')
+parser.add_argument('--grad_compression', type=str, default='none',
+                    choices=['none', 'fp16', 'powersgd'],
+                    help='compression of the (inter-node) all-reduce with --grad_comm')
+parser.add_argument('--powersgd_rank', type=int, default=4,
+                    help='rank of the PowerSGD gradient approximation')
+parser.add_argument('--local_size', type=int, default=0,
+                    help='ranks per node for --grad_comm=hierarchical, 0 for the number of '
+                         'GPUs (or --local_procs)')
 parser.add_argument('--dist_url', default='env://', type=str,
                     help='url used to set up distributed training')
 parser.add_argument('--dist_backend', default='nccl', type=str, help='distributed backend')
@@ -184,10 +256,16 @@ parser.add_argument('--auto_shutdown_failure_delay_mins', default=60, type=int,
 args = parser.parse_args()
 args.tied = not args.not_tied
 
+if args.local_procs > 1 and 'RANK' not in os.environ:
+    # this is the launcher, the workers run the distributed code path below
+    sys.exit(util.launch_local_procs(args.local_procs, sys.argv))
+
 # global variables
-global_timeit_dict = OrderedDict()
+profiler = StepProfiler(enabled=False)  # replaced in main() with --profile
 global_token_count = 0
 event_writer = util.NoOp()
+comm_state = None  # comm_hooks.GradCommState with --grad_comm
+checkpoint_writer = None  # checkpoint.AsyncCheckpointWriter with --async_checkpoint
 epoch = 0
 train_step = 0
 
@@ -245,7 +323,7 @@ class FileLogger:
 
 class timeit:
     """Decorator to measure length of time spent in the block in millis and log
-  it to TensorBoard."""
+  it to TensorBoard. For per-step phases use the profiler instead."""
 
     def __init__(self, tag="", noop=False):
         self.tag = tag
@@ -262,18 +340,31 @@ class timeit:
             return
         self.end = time.perf_counter()
         interval_ms = 1000 * (self.end - self.start)
-        global_timeit_dict.setdefault(self.tag, []).append(interval_ms)
         newtag = 'times/' + self.tag
         log_tb(newtag, interval_ms)
 
 
 def log_tb(tag, val):
     """Log value to tensorboard (relies on global_token_count rather than step count to give comparable graphs across
-    batch sizes)"""
+    batch sizes). Only buffers it, see metrics.MetricsWriter."""
     global global_token_count, event_writer
     event_writer.add_scalar(tag, val, global_token_count)
 
 
+def log_lamb_rs(optimizer, token_count):
+    """Histograms of the LAMB trust ratios and norms across layers, like pytorch_lamb.log_lamb_rs,
+    but stacked on the device so the copy to the host happens in the metrics writer thread."""
+    results = collections.defaultdict(list)
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            state = optimizer.state[p]
+            for k in ('weight_norm', 'adam_norm', 'trust_ratio'):
+                if k in state:
+                    results[k].append(state[k])
+    for k, v in results.items():
+        event_writer.add_histogram(f'lamb/{k}', torch.stack(v), token_count)
+
+
 PT_TZ = pytz.timezone('America/Los_Angeles')
 
 
@@ -288,6 +379,11 @@ if args.d_embed < 0:
     args.d_embed = args.d_model
 
 assert args.ext_len >= 0, 'extended context length must be non-negative'
+assert not (args.fp16 and args.bf16), '--fp16 and --bf16 are mutually exclusive'
+assert not (args.shard_optimizer and args.local), '--shard_optimizer needs distributed training'
+assert args.grad_comm != 'ddp' or args.grad_compression == 'none', '--grad_compression needs --grad_comm'
+assert args.grad_comm == 'ddp' or not (args.local or args.shard_optimizer), \
+    '--grad_comm needs distributed training without --shard_optimizer'
 
 logger = FileLogger(args.logdir, global_rank=global_rank, local_rank=local_rank)
 
@@ -299,6 +395,9 @@ if torch.cuda.is_available():
     torch.cuda.set_device(args.local_rank)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+if args.local_procs and device.type == 'cpu':
+    # split the cores between the worker processes
+    torch.set_num_threads(max(1, os.cpu_count() // args.local_procs))
 
 ###############################################################################
 # Load data
@@ -409,6 +508,12 @@ def evaluate_and_log(optimizer, eval_iter, split, train_step=-1):
             args.eval_tgt_len, args.ext_len, args.mem_len + args.tgt_len - args.eval_tgt_len)
 
     total_loss, total_len = evaluate(model, eval_iter, split, args.max_eval_steps)
+    if not args.local:
+        # each rank evaluated its own shard of the split; sum them so that all ranks see the
+        # same loss and agree on whether to save the (sharded) best checkpoint
+        totals = torch.tensor([total_loss, total_len], dtype=torch.float64, device=device)
+        totals = util.dist_sum_tensor(totals)
+        total_loss, total_len = totals[0].item(), totals[1].item()
 
     # Switch back to the training mode
     model_to_reset.reset_length(args.tgt_len, args.ext_len, args.mem_len)
@@ -432,10 +537,18 @@ def evaluate_and_log(optimizer, eval_iter, split, train_step=-1):
     # Update checkpoint if validation loss improved.
     if split == 'val' and (not best_val_loss or mean_loss < best_val_loss):
         logger.info('Saving checkpoint for new best loss')
-        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix='best')
+        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix='best', writer=checkpoint_writer,
+                                  sharded=args.sharded_checkpoint, version=train_step)
         best_val_loss = mean_loss
 
 
+def no_sync_unless(sync):
+    """Skips DDP gradient all-reduce for this forward/backward unless `sync` is set."""
+    if sync or not hasattr(model, 'no_sync'):
+        return contextlib.ExitStack()  # no-op context
+    return model.no_sync()
+
+
 def train(va_iter, optimizer, scheduler):
     global global_token_count, event_writer, train_loss, best_val_loss, \
         train_step, last_log_step, epoch
@@ -445,77 +558,131 @@ def train(va_iter, optimizer, scheduler):
     log_tb('sizes/batch_size', args.batch_size)
     log_tb('sizes/seq_size', args.tgt_len)
 
+    # Each step reads batch_size * grad_accum_steps streams and splits them into
+    # micro-batches along the batch dimension. Micro-batch j always gets the same
+    # columns, so it keeps its own mems across steps.
+    accum_steps = args.grad_accum_steps
     tr_iter = corpus.get_dist_iterator(
-        'train', global_rank, max_rank, args.batch_size, args.tgt_len,
+        'train', global_rank, max_rank, args.batch_size * accum_steps, args.tgt_len,
         device=device, ext_len=args.ext_len)
-    mems = tuple()
+    mems = [tuple() for _ in range(accum_steps)]
+    batch_total = None
+    sync_counter = util.SyncCounter()
     log_start_time = time.time()
-    for batch, (data, target, seq_len) in enumerate(tr_iter):
-        assert seq_len == data.shape[0]
-        for i in range(1, data.shape[0]):
-            assert torch.all(torch.eq(data[i], target[i - 1]))
-            break
-
-        batch_total = torch.tensor(data.shape[1]).to(device)
-        batch_total = batch_total.to(device)  # needed for NCCL sync
-        if args.local:
-            batch_total = batch_total.sum()
-        else:
-            batch_total = util.dist_sum_tensor(batch_total)  # global batch size
-            batch_total = util.toscalar(batch_total)
-
-        total_tokens = batch_total * seq_len
-        should_log = train_step < args.verbose_log_steps or train_step % args.log_interval == 0
-
-        global_token_count += total_tokens
-        model.zero_grad()
-        ret = model(data, target, *mems)
-        loss, mems = ret[0], ret[1:]
-        loss = loss.float().mean().type_as(loss)
-        with timeit('backwards', noop=not should_log):
-            if args.fp16:
-                optimizer.backward(loss)
+    for batch, (data, target, seq_len) in enumerate(profiler.iter('data', tr_iter)):
+        tracing_syncs = train_step < args.trace_syncs
+        # restores the patched tensor methods even if the step raises
+        with sync_counter if tracing_syncs else contextlib.ExitStack():
+            assert seq_len == data.shape[0]
+            if args.debug_asserts:
+                for i in range(1, data.shape[0]):
+                    assert torch.all(torch.eq(data[i], target[i - 1]))
+                    break
+
+            # every rank uses the same batch size, so with --no_host_sync the global
+            # batch size is all-reduced once instead of every step
+            if batch_total is None or not args.no_host_sync:
+                if args.local:
+                    batch_total = data.shape[1]
+                else:
+                    batch_total = torch.tensor(data.shape[1]).to(device)  # needed for NCCL sync
+                    batch_total = util.dist_sum_tensor(batch_total)  # global batch size
+                    batch_total = util.toscalar(batch_total)
+
+            total_tokens = batch_total * seq_len
+            should_log = train_step < args.verbose_log_steps or train_step % args.log_interval == 0
+
+            global_token_count += total_tokens
+            model.zero_grad()
+            micro_batches = zip(data.chunk(accum_steps, 1), target.chunk(accum_steps, 1))
+            for micro_step, (data_i, target_i) in enumerate(micro_batches):
+                # gradients are only all-reduced on the last micro-batch, and never by DDP
+                # when the optimizer is sharded (it reduce-scatters them itself)
+                with no_sync_unless(micro_step == accum_steps - 1 and not args.shard_optimizer):
+                    with profiler.phase('copy'):  # the split is device-resident, this is slicing
+                        data_i, target_i = data_i.contiguous(), target_i.contiguous()
+                    with profiler.phase('forward'):
+                        ret = model(data_i, target_i, *mems[micro_step])
+                        loss, mems[micro_step] = ret[0], ret[1:]
+                    with profiler.phase('loss'):
+                        loss = loss.float().mean().type_as(loss) / accum_steps
+                    with profiler.phase('backward'):
+                        if args.fp16 or args.shard_optimizer:
+                            optimizer.backward(loss, update_master_grads=False)
+                        else:
+                            loss.backward()
+                    if hasattr(model, 'pop_comm_ms'):
+                        profiler.add('allreduce', model.pop_comm_ms())  # part of backward
+                with profiler.phase('loss'):
+                    if args.no_host_sync:
+                        train_loss += loss.detach().float()  # read back at log time
+                    else:
+                        train_loss += loss.float().item()
+            if args.fp16 or args.shard_optimizer:
+                # overflow check and fp32 copy run once on the accumulated gradients
+                # (the sharded optimizer also reduce-scatters them here)
+                with profiler.phase('overflow'):
+                    optimizer.update_master_grads()
+                with profiler.phase('clip'):
+                    optimizer.clip_master_grads(args.clip)
             else:
-                loss.backward()
-        train_loss += loss.float().item()
+                with profiler.phase('clip'):
+                    if args.no_host_sync:
+                        util.clip_grad_norm_(model.parameters(), args.clip)
+                    else:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
 
-        if args.fp16:
-            optimizer.clip_master_grads(args.clip)
-        else:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            with profiler.phase('optimizer'):
+                optimizer.step()
 
-        optimizer.step()
+            train_step += 1
 
-        train_step += 1
-
-        # step-wise learning rate annealing
-        if args.fp16 and optimizer.overflow:
-            logger.info("skipped iteration")
-        else:
-            if args.scheduler in ['cosine', 'constant', 'dev_perf']:
-                # linear warmup stage
-                if global_token_count < args.warmup_tokens:
-                    curr_lr = args.lr * global_token_count / args.warmup_tokens
-                    optimizer.param_groups[0]['lr'] = curr_lr
-                elif args.scheduler == 'cosine':
-                    scheduler.step(global_token_count)
+            # step-wise learning rate annealing
+            if args.fp16 and optimizer.overflow:
+                logger.info("skipped iteration")
             else:
-                scheduler.step(global_token_count)
-
+                with profiler.phase('scheduler'):
+                    if args.scheduler in ['cosine', 'constant', 'dev_perf']:
+                        # linear warmup stage
+                        if global_token_count < args.warmup_tokens:
+                            curr_lr = args.lr * global_token_count / args.warmup_tokens
+                            optimizer.param_groups[0]['lr'] = curr_lr
+                        elif args.scheduler == 'cosine':
+                            scheduler.step(global_token_count)
+                    else:
+                        scheduler.step(global_token_count)
+            profiler.step_done()
+
+        if tracing_syncs:
+            logger.info(f'host syncs in step {train_step}: {sync_counter.count}')
 
         if should_log:
             elapsed_time = time.time() - log_start_time
             elapsed_steps = train_step - last_log_step
 
             # compute average loss over last logging interval
-            cur_loss = train_loss / elapsed_steps
+            cur_loss = util.toscalar(train_loss) / elapsed_steps
+            tokens_per_sec = elapsed_steps * args.batch_size * accum_steps * args.tgt_len / elapsed_time
             log_str = f'| epoch {epoch:3d} step {train_step:>8d} | {batch:>6d} batches | lr {optimizer.param_groups[0]["lr"]:.3g} ' \
-                      f'| ms/batch {elapsed_time * 1000 / elapsed_steps:5.2f} | loss {cur_loss:5.2f}'
+                      f'| ms/batch {elapsed_time * 1000 / elapsed_steps:5.2f} | tok/s {tokens_per_sec:7.0f} ' \
+                      f'| peak mem {util.peak_memory_gb(device):5.2f}GB | loss {cur_loss:5.2f}'
             if args.dataset in ['enwik8', 'text8']:
                 log_str += f' | bpc {cur_loss / math.log(2):9.5f}'
             else:
                 log_str += f' | ppl {math.exp(cur_loss):9.3f}'
+            if comm_state is not None:
+                intra_bytes, inter_bytes = comm_state.pop_bytes()
+                log_str += f' | comm MB/step intra {intra_bytes / elapsed_steps / 1e6:.2f} ' \
+                           f'inter {inter_bytes / elapsed_steps / 1e6:.2f}'
+                log_tb('comm/intra_mb_per_step', intra_bytes / elapsed_steps / 1e6)
+                log_tb('comm/inter_mb_per_step', inter_bytes / elapsed_steps / 1e6)
             logger.info(log_str)
+            if profiler.enabled:
+                profile_str, profile_stats = profiler.summary()
+                logger.info(profile_str)
+                for name, (p50, p90, p99, mean) in profile_stats.items():
+                    log_tb(f'times/{name}_p50', p50)
+                    log_tb(f'times/{name}_p99', p99)
             log_tb('learning/epoch', epoch)
             log_tb('_loss', cur_loss)  # the most important thing
             log_tb('learning/loss', cur_loss)
@@ -533,10 +700,10 @@ def train(va_iter, optimizer, scheduler):
             linear_scaling_factor = batch_total / 32
             log_tb('learning/base_lr', current_lr / linear_scaling_factor)
             if args.optim == 'lamb':
-                log_lamb_rs(optimizer, event_writer, global_token_count)
+                log_lamb_rs(optimizer, global_token_count)
 
             time_per_batch = elapsed_time / elapsed_steps
-            time_per_sample = time_per_batch / args.batch_size
+            time_per_sample = time_per_batch / (args.batch_size * accum_steps)
             time_per_token = time_per_sample / args.tgt_len
 
             log_tb('times/batches_per_sec', 1 / time_per_batch)
@@ -548,6 +715,7 @@ def train(va_iter, optimizer, scheduler):
                 log_tb("memory/max_allocated_gb", torch.cuda.max_memory_allocated() / 1e9)
                 log_tb("memory/cached_gb", torch.cuda.memory_cached() / 1e9)
                 log_tb("memory/max_cached_gb", torch.cuda.max_memory_cached() / 1e9)
+            event_writer.gather()  # collective with --metrics_aggregate, all ranks log at this step
 
             train_loss = 0
             log_start_time = time.time()
@@ -562,23 +730,25 @@ def train(va_iter, optimizer, scheduler):
 
     if args.checkpoint_each_epoch:
         logger.info(f'Saving checkpoint for epoch {epoch}')
-        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix=f'{epoch}')
+        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix=f'{epoch}', writer=checkpoint_writer,
+                                  sharded=args.sharded_checkpoint, version=train_step)
 
 
 def main():
     global global_token_count, event_writer, train_step, train_loss, last_log_step, \
-        best_val_loss, epoch, model
+        best_val_loss, epoch, model, comm_state, checkpoint_writer, profiler
 
     if args.local_rank > 0:
         pass  # skip shutdown when rank is explicitly set + not zero rank
     else:
-        if not args.local:
+        if not (args.local or args.local_procs):
             os.system('shutdown -c')
 
     if not args.local:
         logger.info(
             f'Distributed initializing process group with {args.dist_backend}, {args.dist_url}, {util.get_world_size()}')
-        dist.init_process_group(backend=args.dist_backend,
+        # nccl needs GPUs
+        dist.init_process_group(backend=args.dist_backend if torch.cuda.is_available() else 'gloo',
                                 init_method=args.dist_url,
                                 world_size=util.get_world_size())
         assert (util.get_world_size() == dist.get_world_size())
@@ -590,7 +760,11 @@ def main():
                              tie_projs=tie_projs, pre_lnorm=args.pre_lnorm, tgt_len=args.tgt_len,
                              ext_len=args.ext_len, mem_len=args.mem_len, cutoffs=cutoffs,
                              same_length=args.same_length, attn_type=args.attn_type,
-                             clamp_len=args.clamp_len, sample_softmax=args.sample_softmax)
+                             clamp_len=args.clamp_len, sample_softmax=args.sample_softmax,
+                             sample_alias=args.sample_alias, sample_reuse=args.sample_reuse)
+    model.set_recompute(args.recompute, args.recompute_every)
+    if args.fused_ff:
+        model.set_fused_ff(True)
 
     # log model info
     n_all_param = sum([p.nelement() for p in model.parameters()])
@@ -629,27 +803,55 @@ def main():
     model = model.to(device)
     if args.fp16:
         model = FP16_Module(model)
+    elif args.bf16:
+        model = BF16_Module(model)
+    if args.shard_optimizer:
+        optimizer = ShardedOptimizer(optimizer,
+                                     static_loss_scale=args.static_loss_scale if args.fp16 else 1.0,
+                                     dynamic_loss_scale=args.fp16 and args.dynamic_loss_scale,
+                                     dynamic_loss_args={'init_scale': 2 ** 16},
+                                     verbose=global_rank == 0)
+    elif args.fp16:
         optimizer = FP16_Optimizer(optimizer,
                                    static_loss_scale=args.static_loss_scale,
                                    dynamic_loss_scale=args.dynamic_loss_scale,
                                    dynamic_loss_args={'init_scale': 2 ** 16},
-                                   verbose=False)
+                                   verbose=False,
+                                   clip_grad_norm=util.clip_grad_norm_ if args.no_host_sync else None)
 
     if args.local:
         model = nn.DataParallel(model, dim=1)
+    elif device.type == 'cpu':
+        model = BucketedDistributedDataParallel(model, bucket_cap_mb=args.bucket_cap_mb)
     else:
         # Uncomment find_unused_parameters and upgrade to torch 1.1 for adaptive embedding.
         model = DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank) #, find_unused_parameters=True)
 
-    if global_rank == 0:
-        event_writer = SummaryWriter(args.logdir)
+    if args.grad_comm != 'ddp':
+        local_size = args.local_size or torch.cuda.device_count() or args.local_procs
+        comm_state = GradCommState(local_size=local_size if args.grad_comm == 'hierarchical' else 1,
+                                   compression=args.grad_compression,
+                                   powersgd_rank=args.powersgd_rank)
+        model.register_comm_hook(comm_state, ddp_comm_hook if isinstance(model, DistributedDataParallel)
+                                 else reduce_gradients)
+
+    if global_rank == 0 or args.metrics_aggregate:
+        event_writer = MetricsWriter(args.logdir, flush_secs=args.metrics_flush_secs, rank=global_rank,
+                                     world_size=max_rank, aggregate=args.metrics_aggregate,
+                                     backend=args.metrics_backend)
+
+    if args.async_checkpoint:
+        checkpoint_writer = AsyncCheckpointWriter(args.checkpoint_max_pending, log=logger.info)
+    if args.profile:
+        profiler = StepProfiler(cuda_events=args.profile_cuda_events)
 
     event_writer.add_text('args', str(args))
 
     # test checkpoint writing
     if args.checkpoint_each_epoch:
         logger.info(f'Saving checkpoint for epoch {epoch}')
-        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix=f'{0}')
+        util.dist_save_checkpoint(model, optimizer, args.logdir, suffix=f'{0}', writer=checkpoint_writer,
+                                  sharded=args.sharded_checkpoint, version=train_step)
 
     # Loop over epochs.
     train_step = 0
@@ -658,7 +860,7 @@ def main():
     best_val_loss = None
     va_iter, te_iter = [
         corpus.get_dist_iterator(
-            split, global_rank, max_rank, args.batch_size * 2, args.tgt_len,
+            split, global_rank, max_rank, args.eval_batch_size or args.batch_size * 2, args.tgt_len,
             device=device, ext_len=args.ext_len)
         for split in ('valid', 'test')
     ]
@@ -676,25 +878,33 @@ def main():
     # Eval one more time.
     evaluate_and_log(optimizer, va_iter, 'val', train_step=-1)
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+    if not args.local:
+        dist.barrier()  # every rank's shards and optimizer files are written
+
     # Load the best saved model.
     logger.info("Loading best checkpoint")
-    model_file = os.path.join(args.logdir, 'model-best.pt')
-    if os.path.exists(model_file):
-        with open(model_file, 'rb') as model_f:
-            with timeit('load'):
-                if args.local:
-                    model = torch.load(model_f)
-                else:
-                    model = torch.load(model_f, map_location=lambda storage, loc: storage.cuda(args.local_rank))
-                    model = DistributedDataParallel(
-                        model,
-                        device_ids=[args.local_rank],
-                        output_device=args.local_rank)
+    if os.path.exists(os.path.join(args.logdir, 'model-best.pt')) or \
+            os.path.exists(os.path.join(args.logdir, 'model-best.shards', 'index.json')):
+        with timeit('load'):
+            if args.local:
+                model = util.load_model(args.logdir)
+            elif device.type == 'cpu':
+                model = BucketedDistributedDataParallel(util.load_model(args.logdir, map_location='cpu'),
+                                                        bucket_cap_mb=args.bucket_cap_mb)
+            else:
+                model = util.load_model(args.logdir, map_location=f'cuda:{args.local_rank}')
+                model = DistributedDataParallel(
+                    model,
+                    device_ids=[args.local_rank],
+                    output_device=args.local_rank)
     else:
         logger.warn('no model file, using current model for loss')
 
     # Run on test data.
     evaluate_and_log(optimizer, te_iter, 'test', -1)
+    event_writer.close()
 
 
 if __name__ == '__main__':
@@ -703,7 +913,7 @@ if __name__ == '__main__':
             warnings.simplefilter("ignore", category=UserWarning)
             main()
         if not args.skip_auto_shutdown and args.local_rank == 0:
-            if not args.local:
+            if not (args.local or args.local_procs):
                 os.system(f'sudo shutdown -h -P +{args.auto_shutdown_success_delay_mins}')
     except Exception as e:
         import traceback
@@ -713,5 +923,5 @@ if __name__ == '__main__':
         logger.exception('Failed')
         # in case of exception, wait 2 hours before shutting down
         if not args.skip_auto_shutdown:
-            if not args.local:
+            if not (args.local or args.local_procs):
                 os.system(f'sudo shutdown -h -P +{args.auto_shutdown_failure_delay_mins}')
@@ -1,8 +1,10 @@
+import functools
 import os
 import sys
 
 import torch
 import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 
 def toscalar(t):  # use on python scalars/pytorch scalars
@@ -60,6 +62,118 @@ def dist_sum_tensor(tensor):
     return rt
 
 
+def reset_peak_memory(device):
+    """Starts a new measurement window for peak_memory_gb."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        # resets VmHWM, the RSS high-water mark (Linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_gb(device) -> float:
+    """Peak memory of this process in GB since the start or the last reset_peak_memory:
+    max allocated on CUDA, the RSS high-water mark on CPU."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1e9
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024 / 1e9
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is in kilobytes on Linux, never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+
+
+def clip_grad_norm_(parameters, max_norm, norm_type=2):
+    """Like torch.nn.utils.clip_grad_norm_ (2-norm only), but keeps the norm and clip
+    coefficient on the device so clipping never waits for the GPU."""
+    assert norm_type == 2, 'only the 2-norm is supported'
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if not grads:
+        return torch.tensor(0.)
+    total_norm = torch.stack([g.norm(2) for g in grads]).norm(2)
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.mul_(clip_coef)
+    return total_norm
+
+
+class SyncCounter:
+    """Counts tensor calls that make the host wait for the device (item(), float(),
+    bool(), tolist(), cpu(), numpy()) while started. Only calls on non-CPU tensors are
+    counted: reading a CPU tensor (e.g. an optimizer's step counter) is not a sync, and a
+    CPU-only run always counts 0. Use as a context manager so that the patched tensor
+    methods are restored even if the traced code raises."""
+    METHODS = ('item', 'tolist', 'cpu', 'numpy', '__bool__', '__float__', '__int__')
+
+    def __init__(self):
+        self.count = 0
+        self._saved = {}
+
+    def _wrap(self, orig):
+        @functools.wraps(orig)
+        def counted(tensor, *args_, **kwargs):
+            if tensor.device.type != 'cpu':
+                self.count += 1
+            return orig(tensor, *args_, **kwargs)
+        return counted
+
+    def start(self):
+        self.count = 0
+        for name in self.METHODS:
+            self._saved[name] = getattr(torch.Tensor, name)
+            setattr(torch.Tensor, name, self._wrap(self._saved[name]))
+        return self
+
+    def stop(self):
+        for name, orig in self._saved.items():
+            setattr(torch.Tensor, name, orig)
+        self._saved = {}
+        return self.count
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_args):
+        self.stop()
+
+
+def launch_local_procs(nprocs: int, argv: list) -> int:
+    """Runs `python argv --local_rank i` for i in range(nprocs) as one single-node job
+    (like torch.distributed.launch), waits for all of them and returns the worst exit code."""
+    import signal
+    import socket
+    import subprocess
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    procs = []
+    for rank in range(nprocs):
+        env = dict(os.environ, MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                   WORLD_SIZE=str(nprocs), RANK=str(rank), LOCAL_RANK=str(rank))
+        procs.append(subprocess.Popen([sys.executable] + argv + [f'--local_rank={rank}'], env=env))
+    # turn SIGTERM (e.g. from timeout) into SystemExit so the workers get cleaned up
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    try:
+        return max(abs(p.wait()) for p in procs)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+
+
 # no_op method/object that accept every signature
 class NoOp:
     def __getattr__(self, *_args):
@@ -68,25 +182,44 @@ class NoOp:
         return no_op
 
 
-def dist_restore_from_checkpoint(ddp_model, checkpoint_fn: str, force_fp16=False):
+def dist_restore_from_checkpoint(ddp_model, checkpoint_fn: str, force_fp16=False, bucket_cap_mb=25,
+                                 shared_fs=False):
     """Restores model wrapped in DistributedDataParallel from checkpoint file. Assumes checkpoint was saved
     as torch.save(ddp.module) or distributed_save_checkpoint
+
+    Rank 0 reads the checkpoint and broadcasts parameters and buffers in flat buckets of
+    bucket_cap_mb (a few collectives instead of one per tensor). With shared_fs, every rank
+    reads checkpoint_fn itself (it must be on a filesystem all nodes see) and nothing goes
+    over the network.
     """
+    if shared_fs or get_global_rank() == 0:
+        restore_from_checkpoint(ddp_model.module, checkpoint_fn, force_fp16=force_fp16)
+    if not shared_fs:
+        module = ddp_model.module
+        broadcast_coalesced(list(module.parameters()) + list(module.buffers()), 0, bucket_cap_mb)
 
-    if get_global_rank() == 0:
-        saved_model = torch.load(checkpoint_fn)
-        state_dict = saved_model.state_dict()
-        if force_fp16:
-            for name in state_dict:
-                state_dict[name] = state_dict[name].half()
-        ddp_model.module.load_state_dict(state_dict)
 
-    pp = next(ddp_model.module.parameters())
-    print(f"{get_global_rank()}  -- Before broadcast {pp.view(-1)[0]}")
-    for p in ddp_model.module.parameters():
-        if torch.is_tensor(p):
-            dist.broadcast(p, 0)
-    print(f"{get_global_rank()}  -- After broadcast {pp.view(-1)[0]}")
+def broadcast_coalesced(tensors, src=0, bucket_cap_mb=25):
+    """Broadcasts tensors from src, flattened into buckets of up to bucket_cap_mb per dtype."""
+    groups = {}
+    for t in tensors:
+        groups.setdefault(t.dtype, []).append(t)
+    cap = bucket_cap_mb * 2 ** 20
+    for group in groups.values():
+        bucket, size = [], 0
+        for t in group + [None]:
+            if bucket and (t is None or size + t.numel() * t.element_size() > cap):
+                if dist.get_rank() == src:
+                    dist.broadcast(_flatten_dense_tensors([b.data for b in bucket]), src)
+                else:
+                    flat = bucket[0].new_empty(sum(b.numel() for b in bucket))
+                    dist.broadcast(flat, src)
+                    for b, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                        b.data.copy_(synced)
+                bucket, size = [], 0
+            if t is not None:
+                bucket.append(t)
+                size += t.numel() * t.element_size()
 
 
 def restore_from_checkpoint(model, checkpoint_fn: str, force_fp16=False):
@@ -94,22 +227,92 @@ def restore_from_checkpoint(model, checkpoint_fn: str, force_fp16=False):
     as torch.save(ddp.module) or distributed_save_checkpoint
     """
 
-    saved_model = torch.load(checkpoint_fn)
-    state_dict = saved_model.state_dict()
+    state_dict = _load_state_dict(checkpoint_fn)
     if force_fp16:
         for name in state_dict:
             state_dict[name] = state_dict[name].half()
     model.load_state_dict(state_dict)
 
 
-def dist_save_checkpoint(ddp_model, optimizer_, directory: str, suffix=''):
-    """Saves model/optimizer into {directory}/optimizer-{suffix}.py and {directory}/model-{suffix}.pt"""
-    if get_global_rank() != 0:
+def _load_state_dict(checkpoint_fn: str):
+    """state_dict of a pickled model file, or of a sharded checkpoint directory (tensors are
+    memory-mapped, see checkpoint.py)"""
+    if os.path.isdir(checkpoint_fn):
+        from checkpoint import ShardedCheckpoint
+        return ShardedCheckpoint(checkpoint_fn).state_dict()
+    return torch.load(checkpoint_fn).state_dict()
+
+
+def load_model(directory: str, suffix='best', map_location=None):
+    """Loads model-{suffix} from directory: the sharded checkpoint directory
+    model-{suffix}.shards if there is one, model-{suffix}.pt otherwise. A sharded checkpoint
+    loaded to CPU stays memory-mapped until the weights are used."""
+    sharded_dir = os.path.join(directory, f'model-{suffix}.shards')
+    if os.path.exists(os.path.join(sharded_dir, 'index.json')):
+        from checkpoint import load_sharded_model
+        return load_sharded_model(sharded_dir, device=map_location or 'cpu')
+    with open(os.path.join(directory, f'model-{suffix}.pt'), 'rb') as f:
+        return torch.load(f, map_location=map_location)
+
+
+def dist_save_checkpoint(ddp_model, optimizer_, directory: str, suffix='', writer=None, sharded=False,
+                         version=''):
+    """Saves model/optimizer into {directory}/optimizer-{suffix}.py and {directory}/model-{suffix}.pt
+
+    With sharded=True, the model goes to the sharded checkpoint directory
+    {directory}/model-{suffix}.shards instead, each rank writing part of the tensors (so all
+    ranks must call this); version tells the shards of one save from those of the next.
+    With a checkpoint.AsyncCheckpointWriter, only the snapshot to host memory happens here
+    and the files are written in the background."""
+    files = {}
+    if hasattr(optimizer_, 'shards'):
+        # ShardedOptimizer: every rank saves its own slice of the optimizer state, tagged with
+        # the version so that load_optimizer_shard can tell slices of different saves apart
+        state_dict = optimizer_.state_dict()
+        state_dict['version'] = str(version)
+        files[directory + f'/optimizer-{suffix}-rank{get_global_rank()}.pt'] = state_dict
+    if sharded:
+        from checkpoint import sharded_save_files
+        files.update(sharded_save_files(ddp_model.module, directory + f'/model-{suffix}.shards',
+                                        get_global_rank(), get_world_size(), version=version))
+    if get_global_rank() == 0:
+        if not sharded:
+            files[directory + f'/model-{suffix}.pt'] = ddp_model.module
+        if not hasattr(optimizer_, 'shards'):
+            files[directory + f'/optimizer-{suffix}.pt'] = optimizer_.state_dict()
+    if not files:
+        return
+    if writer is not None:
+        writer.save(files, tag=suffix)
         return
-    with open(directory + f'/model-{suffix}.pt', 'wb') as f_1:
-        torch.save(ddp_model.module, f_1)
-    with open(directory + f'/optimizer-{suffix}.pt', 'wb') as f_1:
-        torch.save(optimizer_.state_dict(), f_1)
+    if sharded:
+        from checkpoint import atomic_save
+        for fn, obj in files.items():
+            atomic_save(obj, fn)
+        return
+    for fn, obj in files.items():
+        with open(fn, 'wb') as f_1:
+            torch.save(obj, f_1)
+
+
+def load_optimizer_shard(optimizer_, directory: str, suffix='best', version=None):
+    """Loads this rank's {directory}/optimizer-{suffix}-rank{N}.pt into the ShardedOptimizer
+    optimizer_ (all ranks must call this). Raises if the ranks' files come from different
+    saves, or, when version is given (e.g. the version of the sharded model checkpoint), from
+    another save than that one."""
+    with open(directory + f'/optimizer-{suffix}-rank{get_global_rank()}.pt', 'rb') as f:
+        state_dict = torch.load(f, map_location='cpu')
+    saved_version = state_dict.pop('version', None)
+    versions = [saved_version]
+    if dist.is_available() and dist.is_initialized():
+        versions = [None] * dist.get_world_size()
+        dist.all_gather_object(versions, saved_version)
+    if len(set(versions)) > 1:
+        raise RuntimeError(f'optimizer-{suffix} shards were saved at different steps: {versions}')
+    if version is not None and saved_version != str(version):
+        raise RuntimeError(f'optimizer-{suffix} is version {saved_version}, expected {version}')
+    optimizer_.load_state_dict(state_dict)
+    return saved_version
 
 
 def dict_to_args(dict_: dict):
@@ -1,6 +1,11 @@
+import contextlib
+import time
+from collections import OrderedDict
 
 from torch.nn.parallel import DataParallel
 import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.nn.parallel._functions import Scatter
 from torch.nn.parallel.parallel_apply import parallel_apply
 
@@ -89,3 +94,142 @@ class BalancedDataParallel(DataParallel):
             return super().scatter(inputs, kwargs, device_ids)
         return scatter_kwargs(inputs, kwargs, device_ids, chunk_sizes, dim=self.dim)
 
+
+
+class BucketedDistributedDataParallel(torch.nn.Module):
+    """Multi-process data parallelism with gradient all-reduce overlapped with backward.
+
+    Every process keeps its own persistent replica (and its own mems), unlike DataParallel,
+    which replicates the module and gathers all outputs onto one device every forward.
+    Gradients are grouped into buckets of about bucket_cap_mb in reverse registration order
+    (roughly the order backward produces them). A hook on each parameter's AccumulateGrad
+    node marks it ready, and a full bucket is all-reduced asynchronously while backward
+    keeps running. Buckets are launched strictly in order so that all ranks issue the same
+    sequence of collectives; buckets holding parameters that got no gradient this pass are
+    flushed, zero-filled, when backward finishes.
+
+    Works with any backend, including gloo on CPU. Buffers are broadcast from rank 0 once at
+    construction, not every forward (MemTransformerLM's buffers are constant).
+    """
+
+    def __init__(self, module, bucket_cap_mb=25):
+        super(BucketedDistributedDataParallel, self).__init__()
+        self.module = module
+        self.world_size = dist.get_world_size()
+        self.require_backward_grad_sync = True
+        self.comm_ms = 0.
+
+        with torch.no_grad():
+            for tensors in _group_by_dtype(list(module.parameters()) + list(module.buffers())):
+                flat = _flatten_dense_tensors(tensors)
+                dist.broadcast(flat, 0)
+                for t, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                    t.copy_(synced)
+
+        params = [p for p in module.parameters() if p.requires_grad]
+        self.buckets = []
+        cap = bucket_cap_mb * 2 ** 20
+        for dtype_params in _group_by_dtype(params[::-1]):
+            bucket, size = [], 0
+            for p in dtype_params:
+                bucket.append(p)
+                size += p.numel() * p.element_size()
+                if size >= cap:
+                    self.buckets.append(bucket)
+                    bucket, size = [], 0
+            if bucket:
+                self.buckets.append(bucket)
+        self.bucket_of = {p: i for i, bucket in enumerate(self.buckets) for p in bucket}
+        self.bytes_per_sync = sum(p.numel() * p.element_size() for p in params)
+
+        # AccumulateGrad nodes run once per backward, after all of a parameter's
+        # gradient contributions (e.g. tied weights) are summed into p.grad
+        self.grad_accs = []
+        for p in params:
+            grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+            grad_acc.register_hook(self._make_hook(p))
+            self.grad_accs.append(grad_acc)
+        self._sync_this_pass = False
+        self._comm_state, self._comm_hook = None, None
+
+    def register_comm_hook(self, state, hook):
+        """Replaces the async all-reduce of each bucket with hook(state, flat_grads, bucket_index),
+        which must average flat_grads across ranks in place (see comm_hooks.reduce_gradients)."""
+        self._comm_state, self._comm_hook = state, hook
+
+    @contextlib.contextmanager
+    def no_sync(self):
+        """Accumulates gradients locally for the forward/backward passes inside."""
+        old = self.require_backward_grad_sync
+        self.require_backward_grad_sync = False
+        try:
+            yield
+        finally:
+            self.require_backward_grad_sync = old
+
+    def forward(self, *inputs, **kwargs):
+        self._sync_this_pass = (self.require_backward_grad_sync and self.training
+                                and torch.is_grad_enabled())
+        if self._sync_this_pass:
+            self._pending = [len(bucket) for bucket in self.buckets]
+            self._next_bucket = 0
+            self._works = []
+            self._finalize_queued = False
+        return self.module(*inputs, **kwargs)
+
+    def pop_comm_ms(self):
+        """Milliseconds backward spent blocked on gradient communication (waiting for
+        all-reduces, or inside blocking comm hooks) since the last call."""
+        ms, self.comm_ms = self.comm_ms, 0.
+        return ms
+
+    def _make_hook(self, param):
+        def hook(*unused):
+            if not self._sync_this_pass:
+                return
+            if not self._finalize_queued:
+                torch.autograd.Variable._execution_engine.queue_callback(self._finalize)
+                self._finalize_queued = True
+            i = self.bucket_of[param]
+            self._pending[i] -= 1
+            while self._next_bucket < len(self.buckets) and self._pending[self._next_bucket] == 0:
+                self._launch(self._next_bucket)
+        return hook
+
+    def _launch(self, i):
+        bucket = self.buckets[i]
+        grads = [p.grad.data if p.grad is not None else torch.zeros_like(p.data) for p in bucket]
+        flat = _flatten_dense_tensors(grads)
+        if self._comm_hook is not None:
+            start = time.perf_counter()
+            self._works.append((i, self._comm_hook(self._comm_state, flat, i), None))
+            self.comm_ms += 1000 * (time.perf_counter() - start)
+        else:
+            flat.div_(self.world_size)
+            self._works.append((i, flat, dist.all_reduce(flat, async_op=True)))
+        self._next_bucket += 1
+
+    def _finalize(self):
+        # buckets with parameters unused in this pass were never completed
+        while self._next_bucket < len(self.buckets):
+            self._launch(self._next_bucket)
+        for i, flat, work in self._works:
+            if work is not None:
+                start = time.perf_counter()
+                work.wait()
+                self.comm_ms += 1000 * (time.perf_counter() - start)
+            bucket = self.buckets[i]
+            for p, grad in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                if p.grad is None:
+                    p.grad = grad
+                else:
+                    p.grad.data.copy_(grad)
+        self._works = []
+        self._sync_this_pass = False
+
+
+def _group_by_dtype(tensors):
+    groups = OrderedDict()
+    for t in tensors:
+        groups.setdefault(t.dtype, []).append(t)
+    return list(groups.values())
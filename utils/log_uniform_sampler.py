@@ -3,7 +3,7 @@ from torch import nn
 import numpy as np
 
 class LogUniformSampler(object):
-    def __init__(self, range_max, n_sample):
+    def __init__(self, range_max, n_sample, use_alias=False, resample_every=1):
         """
         Reference : https://github.com/tensorflow/tensorflow/blob/r1.10/tensorflow/python/ops/candidate_sampling_ops.py
             `P(class) = (log(class + 2) - log(class + 1)) / log(range_max + 1)`
@@ -12,6 +12,11 @@ class LogUniformSampler(object):
         and we use a numerically stable version -expm1(num_tries * log1p(-p))
 
         Our implementation fixes num_tries at 2 * n_sample, and the actual #samples will vary from run to run
+
+        use_alias: draw negatives with Walker's alias method (O(1) per draw, on
+            the labels' device) instead of torch.multinomial on the CPU
+        resample_every: reuse the same negatives for this many calls to
+            sample(), e.g. across the micro-batches of one optimizer step
         """
         with torch.no_grad():
             self.range_max = range_max
@@ -22,6 +27,47 @@ class LogUniformSampler(object):
             self.log_q = (- (-self.dist.double().log1p_() * 2 * n_sample).expm1_()).log_().float()
 
         self.n_sample = n_sample
+        self.use_alias = use_alias
+        self.resample_every = resample_every
+        if use_alias:
+            self.alias_prob, self.alias_idx = build_alias_table(self.dist)
+
+        self._device_tables = {}
+        self._neg_samples = None
+        self._n_calls = 0
+
+    def _tables(self, device):
+        """Returns (dist, log_q, alias_prob, alias_idx) on `device`, moving them there once."""
+        if not hasattr(self, '_device_tables'):  # sampler pickled before tables were cached
+            self._device_tables = {}
+        key = str(device)
+        if key not in self._device_tables:
+            alias = (self.alias_prob, self.alias_idx) if getattr(self, 'use_alias', False) else (None, None)
+            self._device_tables[key] = tuple(
+                t.to(device) if t is not None else None
+                for t in (self.dist, self.log_q) + alias)
+        return self._device_tables[key]
+
+    def __getstate__(self):
+        # Device copies are a cache; rebuild them after unpickling.
+        state = self.__dict__.copy()
+        state['_device_tables'] = {}
+        state['_neg_samples'] = None
+        state['_n_calls'] = 0
+        return state
+
+    def draw(self, device):
+        """Draws a fresh, sorted set of unique negative samples on `device`."""
+        n_tries = 2 * self.n_sample
+        dist, _, alias_prob, alias_idx = self._tables(device)
+        with torch.no_grad():
+            if alias_prob is not None:
+                bins = torch.randint(0, self.range_max, (n_tries,), device=device)
+                coin = torch.rand(n_tries, device=device)
+                neg_samples = torch.where(coin < alias_prob[bins], bins, alias_idx[bins])
+            else:
+                neg_samples = torch.multinomial(dist, n_tries, replacement=True)
+            return neg_samples.unique()
 
     def sample(self, labels):
         """
@@ -31,19 +77,60 @@ class LogUniformSampler(object):
             samp_log_probs: [n_sample]
             neg_samples: [n_sample]
         """
-
-        # neg_samples = torch.empty(0).long()
-        n_sample = self.n_sample
-        n_tries = 2 * n_sample
-
+        device = labels.device
+        resample_every = getattr(self, 'resample_every', 1)
+        n_calls = getattr(self, '_n_calls', 0)
+        neg_samples = getattr(self, '_neg_samples', None)
+        if neg_samples is None or neg_samples.device != device or n_calls % resample_every == 0:
+            neg_samples = self.draw(device)
+            self._neg_samples = neg_samples if resample_every > 1 else None
+        self._n_calls = n_calls + 1
+
+        _, log_q, _, _ = self._tables(device)
         with torch.no_grad():
-            neg_samples = torch.multinomial(self.dist, n_tries, replacement=True).unique()
-            device = labels.device
-            neg_samples = neg_samples.to(device)
-            true_log_probs = self.log_q[labels].to(device)
-            samp_log_probs = self.log_q[neg_samples].to(device)
+            true_log_probs = log_q[labels]
+            samp_log_probs = log_q[neg_samples]
             return true_log_probs, samp_log_probs, neg_samples
 
+
+def build_alias_table(probs):
+    """Vose's alias method. Returns (prob, alias) such that drawing a bin `k`
+    uniformly and keeping it with probability prob[k] (else taking alias[k])
+    samples from `probs`."""
+    probs = probs.double().numpy()
+    n = len(probs)
+    scaled = probs * n / probs.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # whatever is left over is 1.0 up to rounding error
+    return torch.from_numpy(prob).float(), torch.from_numpy(alias).long()
+
+
+def mask_accidental_hits(sample_logits, labels, neg_samples):
+    """Sets sample_logits[i, j, k] to -1e30 where labels[i, j] == neg_samples[k].
+
+    neg_samples is sorted and unique, so each label hits at most one sample and
+    a binary search finds it; this avoids a dense [b1 x b2 x n_sample] mask.
+    """
+    pos = torch.searchsorted(neg_samples, labels).clamp_(max=neg_samples.size(0) - 1)
+    hit = neg_samples[pos] == labels
+    # adding -1e30 swamps the logit, same as masked_fill_ but sparse
+    penalty = hit.type_as(sample_logits).mul_(-1e30)
+    sample_logits.scatter_add_(-1, pos.unsqueeze(-1), penalty.unsqueeze(-1))
+    return sample_logits
+
+
 def sample_logits(embedding, bias, labels, inputs, sampler):
     """
         embedding: an nn.Embedding layer
@@ -66,13 +153,11 @@ def sample_logits(embedding, bias, labels, inputs, sampler):
     true_b = all_b[: -n_sample].view(b1, b2)
     sample_b = all_b[- n_sample:]
 
-    hit = (labels[:, :, None] == neg_samples).detach()
-
     true_logits = torch.einsum('ijk,ijk->ij',
         [true_w, inputs]) + true_b - true_log_probs
     sample_logits = torch.einsum('lk,ijk->ijl',
         [sample_w, inputs]) + sample_b - samp_log_probs
-    sample_logits.masked_fill_(hit, -1e30)
+    mask_accidental_hits(sample_logits, labels.detach(), neg_samples)
     logits = torch.cat([true_logits[:, :, None], sample_logits], -1)
 
     return logits
@@ -121,27 +206,35 @@ if __name__ == '__main__':
 
     labels = torch.LongTensor(S, B).random_(0, n_vocab)
 
-    # sampler = LogUniformSampler(n_vocab, unique=False)
-    # new_labels, sample, sample_prob = sampler.sample(n_sample, labels)
-
-    sampler = LogUniformSampler(n_vocab, unique=True)
-    # true_probs, samp_probs, neg_samples = sampler.sample(n_sample, labels)
-
-    # print('true_probs', true_probs.numpy().tolist())
-    # print('samp_probs', samp_probs.numpy().tolist())
-    # print('neg_samples', neg_samples.numpy().tolist())
-
-    # print('sum', torch.sum(sampler.dist).item())
-
-    # assert torch.all(torch.sort(sample.unique())[0].eq(torch.sort(sample)[0])).item()
+    for use_alias in (False, True):
+        sampler = LogUniformSampler(n_vocab, n_sample, use_alias=use_alias, resample_every=2)
+        true_probs, samp_probs, neg_samples = sampler.sample(labels)
+        assert torch.equal(neg_samples, sampler.sample(labels)[2]), 'negatives not reused'
+
+        print('use_alias', use_alias)
+        print('true_probs', true_probs.numpy().tolist())
+        print('samp_probs', samp_probs.numpy().tolist())
+        print('neg_samples', neg_samples.numpy().tolist())
+
+    # alias draws follow the log-uniform distribution
+    sampler = LogUniformSampler(n_vocab, n_sample, use_alias=True)
+    _, _, alias_prob, alias_idx = sampler._tables('cpu')
+    bins = torch.randint(0, n_vocab, (1000000,))
+    draws = torch.where(torch.rand(bins.size(0)) < alias_prob[bins], bins, alias_idx[bins])
+    freq = torch.bincount(draws, minlength=n_vocab).float() / draws.size(0)
+    print('max |freq - P| on top 10 classes', (freq[:10] - sampler.dist[:10]).abs().max().item())
+
+    # sorted-search hit masking agrees with the dense broadcast comparison
+    labels[0, 0] = neg_samples[0]
+    labels[1, 2] = neg_samples[-1]
+    logits = torch.Tensor(S, B, neg_samples.size(0)).normal_()
+    dense = logits.masked_fill(labels[:, :, None] == neg_samples, -1e30)
+    assert torch.allclose(mask_accidental_hits(logits.clone(), labels, neg_samples), dense)
 
     embedding = nn.Embedding(n_vocab, H)
     bias = torch.zeros(n_vocab)
     inputs = torch.Tensor(S, B, H).normal_()
 
-    logits, out_labels = sample_logits(embedding, bias, labels, inputs, sampler, n_sample)
+    logits = sample_logits(embedding, bias, labels, inputs, sampler)
     print('logits', logits.detach().numpy().tolist())
     print('logits shape', logits.size())
-    print('out_labels', out_labels.detach().numpy().tolist())
-    print('out_labels shape', out_labels.size())
-
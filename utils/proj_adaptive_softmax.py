@@ -12,6 +12,12 @@ if torch.cuda.is_available():
   CUDA_MINOR = int(torch.version.cuda.split('.')[1])
 
 
+def fp32_if_bf16(x):
+    """Upcasts bf16 tensors before softmax / normalization. bf16 has too few mantissa
+    bits for these; fp16 inputs are left alone to keep the FP16_Module path unchanged."""
+    return x.float() if x.dtype == torch.bfloat16 else x
+
+
 class ProjectedAdaptiveLogSoftmax(nn.Module):
     def __init__(self, n_token, d_embed, d_proj, cutoffs, div_val=1,
                  keep_order=False):
@@ -86,7 +92,7 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
         if self.n_clusters == 0:
             logit = self._compute_logit(hidden, self.out_layers[0].weight,
                                         self.out_layers[0].bias, self.out_projs[0])
-            nll = -F.log_softmax(logit, dim=-1) \
+            nll = -F.log_softmax(fp32_if_bf16(logit), dim=-1) \
                     .gather(1, target.unsqueeze(1)).squeeze(1)
         else:
             # construct weights and biases
@@ -112,10 +118,10 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
             head_weight, head_bias, head_proj = weights[0], biases[0], self.out_projs[0]
 
             head_logit = self._compute_logit(hidden, head_weight, head_bias, head_proj)
-            head_logprob = F.log_softmax(head_logit, dim=1)
+            head_logprob = F.log_softmax(fp32_if_bf16(head_logit), dim=1)
 
             nll = torch.zeros_like(target,
-                    dtype=hidden.dtype, device=hidden.device)
+                    dtype=head_logprob.dtype, device=hidden.device)
 
             offset = 0
             cutoff_values = [0] + self.cutoffs
@@ -139,7 +145,7 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
                     hidden_i = hidden.index_select(0, indices_i)
 
                     tail_logit_i = self._compute_logit(hidden_i, weight_i, bias_i, proj_i)
-                    tail_logprob_i = F.log_softmax(tail_logit_i, dim=1)
+                    tail_logprob_i = F.log_softmax(fp32_if_bf16(tail_logit_i), dim=1)
 
                     logprob_i = head_logprob_i[:, -i] \
                               + tail_logprob_i.gather(1, target_i[:,None]).squeeze(1)